@@ -0,0 +1,90 @@
+"""
+asyncio client for the read-only trakt lookups used by this project:
+search, show seasons, season episodes and movie releases.
+
+The trakt library is synchronous, so each lookup runs in a worker thread and a semaphore
+bounds how many are in flight at once. Lookups go through the same functions as the rest of
+trakt_utils, so they share the rate limited session and the persistent cache.
+
+The sync wrappers at the bottom (`search_many`, `lookup_tv_many`, ...) run a whole fan-out
+of lookups concurrently and can be called from normal (non-async) code.
+"""
+
+import asyncio
+
+# local
+import trakt_utils
+
+
+# default number of lookups in flight at once
+CONCURRENCY = 8
+
+
+class AsyncTrakt:
+    def __init__(self, concurrency=CONCURRENCY):
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    async def _run(self, fn, *args):
+        if self._semaphore is None:
+            # created lazily, so it belongs to the running event loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            return await asyncio.to_thread(fn, *args)
+
+    async def search(self, query, media_type):
+        return await self._run(trakt_utils.search, query, media_type)
+
+    async def search_tv(self, query):
+        return await self._run(trakt_utils.search_tv, query)
+
+    async def lookup_tv(self, query):
+        return await self._run(trakt_utils.lookup_tv, query)
+
+    async def seasons(self, show):
+        return await self._run(trakt_utils.show_seasons, show)
+
+    async def episodes(self, season):
+        return await self._run(trakt_utils.season_episodes, season)
+
+    async def releases(self, movie):
+        return await self._run(movie.get_releases)
+
+    async def gather(self, fn, items):
+        """ await fn(item) for every item concurrently. returns {item: result} """
+        items = list(dict.fromkeys(items))
+        results = await asyncio.gather(*(fn(item) for item in items))
+        return dict(zip(items, results))
+
+
+def run(fn, items, concurrency=CONCURRENCY):
+    """ sync wrapper: await fn(client, item) for every item concurrently. returns {item: result} """
+    # authenticate once up front, instead of racing to do it from every worker thread
+    trakt_utils.auth_trakt()
+
+    async def main():
+        client = AsyncTrakt(concurrency)
+        return await client.gather(lambda item: fn(client, item), items)
+
+    return asyncio.run(main())
+
+
+def search_many(queries, media_type, concurrency=CONCURRENCY):
+    """ {query: [trakt.movies.Movie or trakt.tv.TVShow]} """
+    return run(lambda client, query: client.search(query, media_type), queries, concurrency)
+
+
+def lookup_tv_many(queries, concurrency=CONCURRENCY):
+    """ {query: trakt_utils.lookup_tv(query)} """
+    return run(AsyncTrakt.lookup_tv, queries, concurrency)
+
+
+def episodes_many(seasons, concurrency=CONCURRENCY):
+    """ {season: [trakt.tv.TVEpisode]} """
+    return run(AsyncTrakt.episodes, seasons, concurrency)
+
+
+def releases_many(movies, concurrency=CONCURRENCY):
+    """ {movie: [trakt.movies.Release]} """
+    return run(AsyncTrakt.releases, movies, concurrency)
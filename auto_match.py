@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+
+"""
+Non-interactive version of `python trakt_utils.py` for large movie lists.
+
+Every title in movie.txt is searched on trakt (concurrently) and the best result is scored on:
+- title similarity to the line in movie.txt
+- the year, if the line has one, e.g. "Alien (1979)"
+- trakt's ranking of the result (a rough popularity measure)
+
+Results scoring at least THRESHOLD (and clearly ahead of the runner-up) are accepted and
+marked as watched on their first release date (or today, see DATE_POLICY), in bulk.
+Everything else is written to REVIEW, for a later interactive pass:
+
+python auto_match.py          # match movie.txt
+python auto_match.py review   # interactive pass over REVIEW
+"""
+
+import datetime
+import difflib
+import re
+import sys
+
+from typing import Optional
+
+# third-party
+import tqdm
+
+# local
+import async_trakt
+import cache
+import trakt_utils
+
+
+MOVIES = "movie.txt"
+REVIEW = "movie-review.txt"
+
+# minimum confidence (0-1) to accept a match without asking
+THRESHOLD = 0.85
+# how far ahead of the second best result the best one has to be
+MARGIN = 0.1
+
+# "release" (first release date of the movie) or "today"
+DATE_POLICY = "release"
+
+YEAR_RE = re.compile(r"^(.*?)\s*\(?((?:18|19|20)\d\d)\)?$")
+
+
+def split_year(line):
+    """ "Alien (1979)" -> ("Alien", 1979) """
+    m = YEAR_RE.match(line)
+    if m and m.group(1):
+        return m.group(1), int(m.group(2))
+    return line, None
+
+
+def confidence(title, year, media, rank) -> float:
+    similarity = difflib.SequenceMatcher(None, cache.normalize(title), cache.normalize(media.title)).ratio()
+
+    if year is None or media.year is None:
+        year_score = 0.5
+    else:
+        year_score = {0: 1.0, 1: 0.5}.get(abs(year - media.year), 0.0)
+
+    popularity = 1 / (1 + rank)
+
+    return 0.6 * similarity + 0.25 * year_score + 0.15 * popularity
+
+
+def best_match(title, year, results):
+    """ (movie, confidence) for the result to accept, or (None, best confidence) """
+    scored = sorted(
+        ((confidence(title, year, media, rank), media) for rank, media in enumerate(results)),
+        key=lambda s: s[0], reverse=True,
+    )
+    if not scored:
+        return None, 0.0
+
+    best, media = scored[0]
+    runner_up = scored[1][0] if len(scored) > 1 else 0.0
+    if best >= THRESHOLD and best - runner_up >= MARGIN:
+        return media, best
+    return None, best
+
+
+def watched_date(releases) -> Optional[datetime.datetime]:
+    if DATE_POLICY == "today":
+        date_obj = datetime.datetime.now()
+    else:
+        dates = [r.release_date for r in releases if r.release_date]
+        if not dates:
+            return None
+        date_obj = datetime.datetime.strptime(min(dates), "%Y-%m-%d")
+
+    # python trakt is doing non-timezone aware datetimes
+    return date_obj + datetime.timedelta(seconds=trakt_utils.OFFSET)
+
+
+def read_movies(fname=MOVIES):
+    with open(fname) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().endswith(":")]
+
+
+def match_movies(lines):
+    """ search for the movies on `lines` and pick a date for each. returns ({movie: watched_at}, [lines to review]) """
+    queries = {line: split_year(trakt_utils.clean_query(line, "movie") or "") for line in lines}
+    results = async_trakt.search_many({title for title, _ in queries.values() if title}, "movie")
+
+    accepted, to_review = {}, []
+    for line in lines:
+        title, year = queries[line]
+        media, _ = best_match(title, year, results.get(title, []))
+        if media is None:
+            to_review.append(line)
+        else:
+            accepted[line] = media
+
+    # the releases are only needed to pick a date
+    releases = {}
+    if DATE_POLICY == "release":
+        releases = async_trakt.releases_many(accepted.values())
+
+    history = {}
+    for line, media in accepted.items():
+        date_obj = watched_date(releases.get(media, []))
+        if date_obj is None:
+            to_review.append(line)
+        else:
+            history[media] = date_obj
+
+    return history, to_review
+
+
+def auto_match(fname=MOVIES, review=REVIEW):
+    history, to_review = match_movies(read_movies(fname))
+
+    with open(review, "w") as f:
+        for line in to_review:
+            f.write(line)
+            f.write("\n")
+
+    print(f"accepted {len(history)} movies, {len(to_review)} left for review in {review}")
+    if not history:
+        return
+
+    batch = trakt_utils.get_journal().append(history)
+    with tqdm.tqdm(total=len(history)) as bar:
+        for res in trakt_utils.upload_journal([batch]):
+            bar.update(len(res.items))
+            if res.skipped:
+                bar.write(f"{res.skipped} of {len(res.items)} movies are already in your history, skipped")
+            if res.not_found:
+                bar.write(f"{res.not_found} of {len(res.items)} movies were not found on trakt")
+
+
+if __name__ == "__main__":
+    trakt_utils.auth_trakt()
+
+    if sys.argv[1:] == ["review"]:
+        trakt_utils.add_media_to_history("movie", REVIEW)
+    else:
+        auto_match()
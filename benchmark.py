@@ -0,0 +1,430 @@
+#! /usr/bin/env python3
+
+"""
+Micro-benchmarks for this project, run against generated data in a temporary directory.
+The trakt lookups and uploads run against a local fake_trakt.FakeTrakt server.
+
+python benchmark.py            # run everything
+python benchmark.py parser     # run only the named benchmarks
+
+It exits with status 1 if a benchmark found a regression (see REGRESSIONS).
+"""
+
+import contextlib
+import datetime as dt
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from types import SimpleNamespace
+
+# third-party
+from picotui.defs import KEY_TAB
+from picotui.screen import Screen
+from picotui.widgets import Dialog
+import trakt.core
+
+# local
+import async_trakt
+import cache
+import catalog
+import coordinator
+import fake_trakt
+import interface
+import planner
+import rate_limit
+import title_index
+import trakt_utils
+import txt_tv_parser as ttp
+from picotui_ext import WEpisodePager
+
+
+BENCHMARKS = {}
+
+# regressions found by the benchmarks that ran
+REGRESSIONS = []
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+def timed(fn, repeat=5) -> float:
+    """ best wall time (in seconds) of `repeat` calls to fn() """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, seconds, items=None):
+    line = f"{name:<40} {seconds * 1000:10.2f} ms"
+    if items:
+        line += f" {items / seconds:14,.0f} items/s"
+    print(line)
+
+
+def write_wikipedia_dump(fname, n):
+    """ n shows in the format of ttp.FNAME, spread over years/months """
+    months = ["January", "February", "March", "April", "May", "June"]
+    with open(fname, "w") as f:
+        for i in range(n):
+            if i % 1000 == 0:
+                f.write(f"{1950 + i // 1000}\n")
+            if i % 100 == 0:
+                f.write(f"{months[(i // 100) % len(months)]}\n\n")
+            f.write(f"    {months[(i // 100) % len(months)]} {i % 28 + 1} {chr(8211)} Show number {i}\n")
+
+
+@contextlib.contextmanager
+def ttp_files(**fnames):
+    """ point ttp's files (e.g. FNAME="wikipedia-tv-shows.txt") into a temporary directory, restored afterwards """
+    saved = {name: getattr(ttp, name) for name in fnames}
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for name, fname in fnames.items():
+                setattr(ttp, name, os.path.join(tmp, fname))
+            yield
+        finally:
+            for name, value in saved.items():
+                setattr(ttp, name, value)
+
+
+@benchmark
+def parser(n=100_000):
+    with ttp_files(FNAME="wikipedia-tv-shows.txt"):
+        write_wikipedia_dump(ttp.FNAME, n)
+
+        report(f"parser: first page (50 of {n:,})", timed(lambda: list(ttp.find_movies(limit=50))))
+        report(f"parser: {n:,} lines", timed(lambda: sum(1 for _ in ttp.find_movies())), n)
+        report(f"parser: {n:,} lines (mmap)", timed(lambda: sum(1 for _ in ttp.find_movies(use_mmap=True))), n)
+
+
+@benchmark
+def selection(n=100_000, new=50):
+    with ttp_files(SELECTED="shows.txt", SELECTED_INDEX="shows.sqlite"):
+        ttp.serialize(f"Show number {i:06}" for i in range(n))
+
+        batches = iter(range(10 ** 6))
+
+        def select():
+            # a new selection pass: mostly known shows plus a few new ones near the end of the list
+            b = next(batches)
+            ttp.serialize([f"Show number {i:06}" for i in range(0, n, n // 100)] + [f"Zz {b} {i}" for i in range(new)])
+
+        report(f"selection: {new} new shows into {n:,}", timed(select), new)
+        report(f"selection: nothing new in {n:,}", timed(lambda: ttp.serialize(["Show number 000001"])))
+
+
+CONSONANTS = "bcdfghjklmnprstvwyz"
+VOWELS = "aeiou"
+
+
+def stylized(title, rng):
+    """ how the same title might be written elsewhere: other punctuation, case, or without "the" """
+    words = title.split()
+    i = rng.randrange(len(words))
+    words[i] = rng.choice([f"{words[i]}:", f"{words[i]}'s", words[i].upper(), f"{words[i]}!", f"{words[i]}."])
+    if words[0] == "The" and rng.random() < 0.5:
+        words = words[1:]
+    return " ".join(words)
+
+
+@benchmark
+def title_matching(known=10_000, selected=1_000):
+    rng = random.Random(0)
+    # titles share words (and so trigrams) like real ones do: "the" is in many of them
+    words = ["the", "of", "and", "show", "night", "new"] + [
+        "".join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(rng.randint(2, 4))) for _ in range(3_000)
+    ]
+    shows = []
+    for i in range(known):
+        title = " ".join(w.capitalize() for w in rng.sample(words[:6], rng.randint(0, 2)) + rng.sample(words[6:], rng.randint(1, 3)))
+        shows.append({"title": title, "year": rng.randint(1950, 2023), "ids": {"trakt": i, "slug": f"show-{i}"}})
+
+    # mostly known shows, written differently than on trakt, with their debut year, and some unknown ones
+    picks = rng.sample(shows, selected * 9 // 10)
+    queries = {stylized(show["title"], rng): show for show in picks}
+    queries.update({f"Unknown Show {i}": None for i in range(selected - len(picks))})
+    years = {query: show["year"] for query, show in queries.items() if show}
+
+    index = title_index.TitleIndex(shows)
+    report(f"title index: build ({known:,} shows)", timed(lambda: title_index.TitleIndex(shows)), known)
+    report(f"title index: match {len(queries):,}", timed(lambda: index.match_many(queries, years), repeat=3), len(queries))
+
+    matches = index.match_many(queries, years)
+    matched = [q for q, m in matches.items() if m]
+    wrong = sum(1 for q in matched if matches[q][0] is not queries[q])
+    print(f"{'':<40} {len(queries) - len(matched):,} of {len(queries):,} left to search on trakt, {wrong} wrong matches")
+
+
+class ScreenOutput:
+    """ swallows what picotui writes to the terminal, counting the bytes """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def __enter__(self):
+        self.wr = Screen.wr
+        Screen.wr = staticmethod(self.write)
+        return self
+
+    def __exit__(self, *exc):
+        Screen.wr = self.wr
+
+    def write(self, s):
+        self.bytes += len(s.encode() if isinstance(s, str) else s)
+
+
+@benchmark
+def pager(sizes=(10, 100, 5_000), presses=200):
+    for n in sizes:
+        episodes = [
+            SimpleNamespace(number=i + 1, title=f"Episode title {i + 1}", first_aired_date="2010-01-01")
+            for i in range(n)
+        ]
+
+        def build():
+            d = Dialog(0, 0, 100, 30)
+            w_pager = WEpisodePager(24, episodes, d, 47, offset=1)
+            d.add(1, 3, w_pager)
+            return d, w_pager
+
+        with ScreenOutput() as out:
+            report(f"pager: open ({n:,} episodes)", timed(lambda: build()[0].redraw()), n)
+
+            d, w_pager = build()
+            d.redraw()
+            # the first tab only focuses the selected episode
+            w_pager.handle_key(KEY_TAB)
+
+            keys = min(presses, n - 1)
+            out.bytes = 0
+            start = time.perf_counter()
+            for _ in range(keys):
+                w_pager.handle_key(KEY_TAB)
+            seconds = time.perf_counter() - start
+
+        report(f"pager: {keys} key presses ({n:,} episodes)", seconds, keys)
+        print(f"{'':<40} {out.bytes / keys:10,.0f} bytes/key press")
+
+
+# modules that `python interface.py` should not need before a trakt path is chosen
+HEAVY_MODULES = ("trakt", "requests", "tqdm")
+
+
+@benchmark
+def startup(repeat=5):
+    """ a fresh interpreter importing interface.py: what `python interface.py` does before the menu is drawn """
+    here = os.path.dirname(os.path.abspath(__file__))
+    # modules imported through interface.lazy_import stay in sys.modules as (unloaded) lazy modules
+    code = (
+        "import interface, sys, types;"
+        f"print(*(m for m in {HEAVY_MODULES!r} if type(sys.modules.get(m)) is types.ModuleType))"
+    )
+
+    def run(c):
+        return subprocess.run([sys.executable, "-c", c], cwd=here, capture_output=True, text=True, check=True).stdout.split()
+
+    report("startup: python", timed(lambda: run("pass"), repeat))
+    report("startup: import interface", timed(lambda: run(code), repeat))
+
+    heavy = run(code)
+    if heavy:
+        REGRESSIONS.append(f"startup: imported before the menu: {', '.join(heavy)}")
+        print(f"{'':<40} REGRESSION: imported before the menu: {', '.join(heavy)}")
+
+
+# sizes (in episodes) for the trakt benchmarks
+EPISODES = (100, 1_000, 10_000)
+# every fake show has 5 seasons of 20 episodes
+SEASONS, SEASON_EPISODES = 5, 20
+# seconds per fake trakt request
+LATENCY = 0.01
+# generous limits: these benchmarks measure our own code and request counts, not trakt's pacing
+GET_LIMIT = (100_000, 300)
+POST_LIMIT = (1_000, 1)
+
+
+@contextlib.contextmanager
+def fake_trakt_env(n_episodes):
+    """
+    point trakt at a local FakeTrakt (with n_episodes episodes in total) and run in a temporary
+    directory, so config.ini, the cache, the catalog, the journal and the rate limiter all start out fresh
+    """
+    fake = fake_trakt.FakeTrakt(
+        shows=n_episodes // (SEASONS * SEASON_EPISODES), seasons=SEASONS, episodes=SEASON_EPISODES,
+        latency=LATENCY, get_limit=GET_LIMIT, post_limit=POST_LIMIT,
+    )
+    saved = (
+        trakt.core.BASE_URL, trakt.core.CONFIG_PATH, trakt.core.session,
+        cache._default, catalog._default, trakt_utils._journal, trakt_utils._offline,
+    )
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            with open("config.ini", "w") as f:
+                f.write("[app]\nid = fake\nsec = fake\ntoken = fake\n")
+
+            trakt.core.BASE_URL = fake.start()
+            trakt.core.CONFIG_PATH = os.path.join(tmp, "pytrakt.json")
+            # a limiter of our own, so nothing is written to ratelimit.json at exit
+            trakt.core.session = rate_limit.RateLimitedSession(rate_limit.RateLimiter())
+            cache._default = None
+            catalog._default = None
+            trakt_utils._journal = None
+            trakt_utils._offline = None
+
+            yield fake
+        finally:
+            fake.stop()
+            (
+                trakt.core.BASE_URL, trakt.core.CONFIG_PATH, trakt.core.session,
+                cache._default, catalog._default, trakt_utils._journal, trakt_utils._offline,
+            ) = saved
+            os.chdir(cwd)
+
+
+def show_names(fake):
+    return [f"Show {i}" for i in range(fake.shows)]
+
+
+def fetch_episodes(fake):
+    """ every (episode, first aired) of the fake server, looked up concurrently """
+    lookups = async_trakt.lookup_tv_many(show_names(fake))
+    seasons = [season for results in lookups.values() for season in results[0]["seasons"]]
+    episodes = async_trakt.episodes_many(seasons)
+    return [(e, e.first_aired_date) for season in seasons for e in episodes[season]]
+
+
+def once(fn):
+    """ wall time (in seconds) of a single call to fn(), for benchmarks that change server state """
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def requests_made(fake):
+    return f"{sum(fake.requests.values()):,} requests, {fake.connections:,} connections"
+
+
+@benchmark
+def lookups(sizes=EPISODES):
+    for n in sizes:
+        with fake_trakt_env(n) as fake:
+            def sequential():
+                for show in show_names(fake):
+                    for season in trakt_utils.lookup_tv(show)[0]["seasons"]:
+                        trakt_utils.season_episodes(season)
+
+            report(f"lookups: sequential ({n:,} episodes)", once(sequential), n)
+            print(f"{'':<40} {requests_made(fake):>30}")
+
+        with fake_trakt_env(n) as fake:
+            report(f"lookups: concurrent ({n:,} episodes)", once(lambda: fetch_episodes(fake)), n)
+
+        with fake_trakt_env(n) as fake:
+            lines = [(f"Show {i}", season, dt.datetime(2020, 1, 1)) for i in range(fake.shows) for season in range(1, SEASONS + 1)]
+            report(f"lookups: structured ({n:,} episodes)", once(lambda: interface.resolve_structured(lines)), n)
+
+
+@benchmark
+def catalog_reads(sizes=EPISODES):
+    for n in sizes:
+        with fake_trakt_env(n) as fake:
+            report(f"catalog: first session ({n:,} episodes)", once(lambda: fetch_episodes(fake)), n)
+            print(f"{'':<40} {requests_made(fake):>30}")
+
+            # a later session: nothing is looked up again, except what changed on trakt
+            fake.requests.clear()
+            report(f"catalog: next session ({n:,} episodes)", once(lambda: fetch_episodes(fake)), n)
+            print(f"{'':<40} {requests_made(fake):>30}")
+
+            fake.requests.clear()
+            fake.update_show(0)
+            report(f"catalog: refresh (1 show updated)", once(lambda: trakt_utils.refresh_catalog(force=True)))
+            fetch_episodes(fake)
+            print(f"{'':<40} {requests_made(fake):>30}")
+
+
+@benchmark
+def backfill(sizes=EPISODES, workers=(1, coordinator.WORKERS)):
+    for n in sizes:
+        for w in sorted(set(workers)):
+            with fake_trakt_env(n) as fake:
+                units = [(f"Show {i}", [(season, dt.datetime(2020, 1, 1)) for season in range(1, SEASONS + 1)]) for i in range(fake.shows)]
+                report(f"backfill: {w} workers ({n:,} episodes)", once(lambda: coordinator.coordinate("structured", units, w)), n)
+                print(f"{'':<40} {requests_made(fake):>30}")
+
+
+@benchmark
+def uploads(sizes=EPISODES):
+    for n in sizes:
+        with fake_trakt_env(n) as fake:
+            items = fetch_episodes(fake)
+            fake.requests.clear()
+            fake.connections = 0
+
+            def episode_updates():
+                existing = trakt_utils.existing_history(min(d for _, d in items), max(d for _, d in items), ["episodes"])
+                for _ in trakt_utils.sync_history(items, existing=existing):
+                    pass
+
+            report(f"uploads: sync_history ({n:,} episodes)", once(episode_updates), n)
+            print(f"{'':<40} {requests_made(fake):>30}")
+
+        with fake_trakt_env(n) as fake:
+            items = fetch_episodes(fake)
+
+            def deferred_updates():
+                batch = trakt_utils.get_journal().append(dict(items))
+                for _ in trakt_utils.upload_journal([batch]):
+                    pass
+
+            report(f"uploads: journal ({n:,} episodes)", once(deferred_updates), n)
+
+
+@benchmark
+def planning(sizes=EPISODES):
+    for n in sizes:
+        with fake_trakt_env(n) as fake:
+            lookups = async_trakt.lookup_tv_many(show_names(fake))
+            j = trakt_utils.get_journal()
+            for results in lookups.values():
+                show = results[0]
+                episodes = async_trakt.episodes_many(show["seasons"])
+                for season in show["seasons"]:
+                    # every episode of a season on the same day, each season picked twice
+                    items = {e: dt.datetime(2020, 1, season.number) for e in episodes[season]}
+                    j.append(items, show_trakt=show["trakt"])
+                    j.append(items, show_trakt=show["trakt"])
+
+            plan = None
+
+            def make_plan():
+                nonlocal plan
+                plan = planner.make_plan()
+
+            report(f"planning: plan ({n:,} episodes)", once(make_plan), n)
+            for line in planner.report(plan).splitlines():
+                print(f"{'':<40} {line}")
+
+            fake.requests.clear()
+            fake.connections = 0
+            report(f"planning: run ({n:,} episodes)", once(lambda: list(planner.run(plan))), n)
+            print(f"{'':<40} {requests_made(fake):>30}")
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+    if REGRESSIONS:
+        sys.exit(1)
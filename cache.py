@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+
+"""
+Persistent cache for trakt lookups (search results).
+Shows' seasons and episodes are kept in the catalog instead (see catalog.py).
+
+Values are stored as json in a sqlite database (DB), keyed by strings like
+`search:show:<normalized query>`.
+Entries expire after TTL seconds, and the least recently used entries are evicted
+once the cache holds more than MAX_ENTRIES.
+
+The cache is safe to share between threads. To clear it (or only keys starting with a prefix):
+python cache.py [prefix]
+"""
+
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+
+DB = "cache.sqlite"
+TTL = 7 * 24 * 60 * 60
+MAX_ENTRIES = 5000
+
+
+def normalize(query):
+    """ lowercase, drop apostrophes and collapse punctuation/whitespace so similar queries share a key """
+    query = re.sub(r"['’]", "", query.lower())
+    return " ".join(re.sub(r"[^\w\s]", " ", query).split())
+
+
+class Cache:
+    def __init__(self, path=DB, ttl=TTL, max_entries=MAX_ENTRIES, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # worker processes (see coordinator.py) share the file: readers don't wait for writers
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key):
+        """ return the cached value for `key`, or None if it is missing or expired """
+        now = self.clock()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            value, created = row
+            with self.conn:
+                if now - created > self.ttl:
+                    self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    return None
+                self.conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+
+        return json.loads(value)
+
+    def set(self, key, value):
+        now = self.clock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._evict()
+
+    def values(self, prefix=""):
+        """ the values of every entry (that has not expired) whose key starts with `prefix` """
+        with self.lock:
+            pattern = re.sub(r"([%_\\])", r"\\\1", prefix) + "%"
+            rows = self.conn.execute(
+                "SELECT value FROM cache WHERE key LIKE ? ESCAPE '\\' AND created >= ?",
+                (pattern, self.clock() - self.ttl),
+            ).fetchall()
+        return [json.loads(value) for value, in rows]
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def invalidate(self, prefix=""):
+        """ remove every entry whose key starts with `prefix` (everything, by default) """
+        with self.lock, self.conn:
+            # escape LIKE wildcards in the prefix
+            pattern = re.sub(r"([%_\\])", r"\\\1", prefix) + "%"
+            cur = self.conn.execute("DELETE FROM cache WHERE key LIKE ? ESCAPE '\\'", (pattern,))
+            return cur.rowcount
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default():
+    """ the cache shared by every flow in this process (opened on first use) """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Cache()
+        return _default
+
+
+if __name__ == "__main__":
+    prefix = sys.argv[1] if len(sys.argv) > 1 else ""
+    print(f"removed {default().invalidate(prefix)} cache entries")
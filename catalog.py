@@ -0,0 +1,266 @@
+#! /usr/bin/env python3
+
+"""
+Local catalog of the tv shows looked up on trakt: shows, their seasons and their episodes
+(trakt ids, titles, air dates) in a sqlite database (CATALOG).
+
+trakt_utils reads seasons and episodes from here first, so the interface only downloads a show's
+metadata once instead of in every session. Entries don't expire: `trakt_utils.refresh_catalog()`
+asks trakt which shows changed since the last refresh (their `updated_at`) and drops only those
+shows' seasons and episodes, which are looked up again the next time they are used.
+
+With `offline = yes` in the [catalog] section of config.ini nothing is looked up on trakt at all:
+shows, seasons and episodes only come from the catalog, and selections stay in the journal until
+they are uploaded later ("select now, upload later").
+
+python catalog.py           # what's in the catalog
+python catalog.py fill      # look up every show in shows.txt / shows-structured.txt, e.g. before going offline
+python catalog.py refresh   # drop the shows that changed on trakt since the last refresh
+"""
+
+import datetime as dt
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+# local
+import cache
+
+
+CATALOG = "catalog.sqlite"
+
+# days between checks for updated shows
+REFRESH_DAYS = 1
+
+# how far back trakt lists updated shows. catalogs refreshed longer ago than this are dropped entirely
+UPDATES_WINDOW = dt.timedelta(days=30)
+
+# as in trakt's api, e.g. 2024-01-31T20:00:00.000Z
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def timestamp(d: dt.datetime) -> str:
+    """ utc datetime -> trakt's format (milliseconds, so it compares with trakt's timestamps as a string) """
+    return f"{d:%Y-%m-%dT%H:%M:%S}.{d.microsecond // 1000:03d}Z"
+
+
+def now():
+    return timestamp(dt.datetime.now(dt.timezone.utc))
+
+
+class Catalog:
+    def __init__(self, path=CATALOG):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # worker processes (see coordinator.py) share the file: readers don't wait for writers
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            # `fetched` is when the show's seasons were looked up (NULL: not yet)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS shows ("
+                " slug TEXT PRIMARY KEY, trakt INTEGER, title TEXT, year INTEGER, query TEXT,"
+                " fetched TEXT, data TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS shows_query ON shows (query)")
+            # `episodes_known` is set once the season's episodes were looked up
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS seasons ("
+                " slug TEXT NOT NULL, number INTEGER NOT NULL, trakt INTEGER, first_aired TEXT,"
+                " episodes_known INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL, PRIMARY KEY (slug, number))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS episodes ("
+                " slug TEXT NOT NULL, season INTEGER NOT NULL, number INTEGER NOT NULL, trakt INTEGER,"
+                " first_aired TEXT, data TEXT NOT NULL, PRIMARY KEY (slug, season, number))"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # a new catalog is up to date
+            self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('refreshed', ?)", (now(),))
+
+    def _put_show(self, show):
+        """ insert or update a show (as in trakt's api: title, year, ids), keeping what is known about its seasons """
+        self.conn.execute(
+            "INSERT INTO shows (slug, trakt, title, year, query, data) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (slug) DO UPDATE SET"
+            " trakt = excluded.trakt, title = excluded.title, year = excluded.year,"
+            " query = excluded.query, data = excluded.data",
+            (
+                show["ids"]["slug"], show["ids"].get("trakt"), show.get("title"), show.get("year"),
+                cache.normalize(show.get("title") or ""), json.dumps(show),
+            ),
+        )
+
+    def put_shows(self, shows):
+        with self.lock, self.conn:
+            for show in shows:
+                self._put_show(show)
+
+    def shows(self):
+        """ every show in the catalog (as in trakt's api) """
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM shows").fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def search(self, query):
+        """ shows whose title matches `query` (as cache.normalize()d) """
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM shows WHERE query = ?", (cache.normalize(query),)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def seasons(self, slug):
+        """ seasons of a show (as in trakt's api), or None if they were not looked up yet """
+        with self.lock:
+            row = self.conn.execute("SELECT fetched FROM shows WHERE slug = ?", (slug,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            rows = self.conn.execute("SELECT data FROM seasons WHERE slug = ? ORDER BY number", (slug,)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def set_seasons(self, show, seasons):
+        with self.lock, self.conn:
+            self._put_show(show)
+            slug = show["ids"]["slug"]
+            numbers = [s["number"] for s in seasons]
+            self.conn.execute(
+                f"DELETE FROM seasons WHERE slug = ? AND number NOT IN ({','.join('?' * len(numbers))})",
+                [slug, *numbers],
+            )
+            self.conn.executemany(
+                "INSERT INTO seasons (slug, number, trakt, first_aired, data) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (slug, number) DO UPDATE SET"
+                " trakt = excluded.trakt, first_aired = excluded.first_aired, data = excluded.data",
+                [
+                    (slug, s["number"], s.get("ids", {}).get("trakt"), s.get("first_aired"), json.dumps(s))
+                    for s in seasons
+                ],
+            )
+            self.conn.execute("UPDATE shows SET fetched = ? WHERE slug = ?", (now(), slug))
+
+    def episodes(self, slug, season):
+        """ episodes of a season (as in trakt's api), or None if they were not looked up yet """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT episodes_known FROM seasons WHERE slug = ? AND number = ?", (slug, season)
+            ).fetchone()
+            if not row or not row[0]:
+                return None
+            rows = self.conn.execute(
+                "SELECT data FROM episodes WHERE slug = ? AND season = ? ORDER BY number", (slug, season)
+            ).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def episode_ids(self, show_trakt, season):
+        """ trakt ids of a season's episodes (by the show's trakt id), or None if they were not looked up yet """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT seasons.slug FROM seasons JOIN shows ON shows.slug = seasons.slug"
+                " WHERE shows.trakt = ? AND seasons.number = ? AND seasons.episodes_known",
+                (show_trakt, season),
+            ).fetchone()
+            if row is None:
+                return None
+            rows = self.conn.execute(
+                "SELECT trakt FROM episodes WHERE slug = ? AND season = ?", (row[0], season)
+            ).fetchall()
+        return {trakt for trakt, in rows}
+
+    def set_episodes(self, slug, season, episodes):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM episodes WHERE slug = ? AND season = ?", (slug, season))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO episodes (slug, season, number, trakt, first_aired, data) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (slug, season, e["number"], e.get("ids", {}).get("trakt"), e.get("first_aired"), json.dumps(e))
+                    for e in episodes
+                ],
+            )
+            # a season whose show's seasons were not looked up (yet) only keeps its number
+            self.conn.execute(
+                "INSERT OR IGNORE INTO seasons (slug, number, data) VALUES (?, ?, ?)",
+                (slug, season, json.dumps({"number": season})),
+            )
+            self.conn.execute("UPDATE seasons SET episodes_known = 1 WHERE slug = ? AND number = ?", (slug, season))
+
+    def _drop(self, slugs):
+        for slug in slugs:
+            self.conn.execute("DELETE FROM episodes WHERE slug = ?", (slug,))
+            self.conn.execute("DELETE FROM seasons WHERE slug = ?", (slug,))
+            self.conn.execute("UPDATE shows SET fetched = NULL WHERE slug = ?", (slug,))
+
+    def updated(self, updates):
+        """
+        drop the seasons and episodes of the shows that changed after they were looked up.
+        `updates` are (slug, updated_at) pairs, returns the number of shows dropped
+        """
+        with self.lock, self.conn:
+            stale = [
+                slug for slug, updated_at in updates
+                if self.conn.execute(
+                    "SELECT 1 FROM shows WHERE slug = ? AND fetched < ?", (slug, updated_at)
+                ).fetchone()
+            ]
+            self._drop(stale)
+        return len(stale)
+
+    def drop_all(self):
+        """ drop every show's seasons and episodes (the shows themselves are kept for offline searches) """
+        with self.lock, self.conn:
+            slugs = [slug for slug, in self.conn.execute("SELECT slug FROM shows WHERE fetched IS NOT NULL")]
+            self._drop(slugs)
+        return len(slugs)
+
+    def refreshed(self) -> dt.datetime:
+        """ when the catalog was last checked for updated shows """
+        with self.lock:
+            value = self.conn.execute("SELECT value FROM meta WHERE key = 'refreshed'").fetchone()[0]
+        return dt.datetime.strptime(value, TIME_FORMAT).replace(tzinfo=dt.timezone.utc)
+
+    def set_refreshed(self, when: str):
+        with self.lock, self.conn:
+            self.conn.execute("REPLACE INTO meta VALUES ('refreshed', ?)", (when,))
+
+    def stats(self):
+        """ (shows, shows with their seasons, seasons with their episodes, episodes) """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT (SELECT COUNT(*) FROM shows), (SELECT COUNT(*) FROM shows WHERE fetched IS NOT NULL),"
+                " (SELECT COUNT(*) FROM seasons WHERE episodes_known), (SELECT COUNT(*) FROM episodes)"
+            ).fetchone()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default():
+    """ the catalog shared by every flow in this process (opened on first use) """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Catalog()
+        return _default
+
+
+if __name__ == "__main__":
+    # trakt_utils uses the `catalog` module, not this script's copy of it
+    import trakt_utils
+
+    import txt_tv_parser as ttp
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "fill":
+        queries = []
+        if os.path.exists(ttp.SELECTED):
+            queries.extend(ttp.get_selected())
+        if os.path.exists(ttp.STRUCTURED):
+            queries.extend(show for show, _, _ in ttp.get_structured())
+        shows, seasons = trakt_utils.fill_catalog(queries)
+        print(f"looked up {shows} shows ({seasons} seasons)")
+    elif command == "refresh":
+        print(f"{trakt_utils.refresh_catalog(force=True)} shows changed on trakt since the last refresh")
+
+    import catalog
+    shows, fetched, seasons, episodes = catalog.default().stats()
+    print(f"{shows} shows ({fetched} with their seasons), {seasons} seasons with {episodes} episodes in {CATALOG}")
@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+
+"""
+Backfill a large movie list or shows-structured.txt with several worker processes.
+
+The input is split into one shard per worker. Each worker looks up and matches its shard (as
+auto_match.py and the structured update in interface.py do, concurrently within the process)
+with its own share of trakt's GET limit, and streams what it resolved back over a queue.
+
+This process is the single writer: it adds whatever arrives to the journal and uploads it in
+bulk as it goes, so it is the only one that sends POSTs (trakt's 1 per second applies to all of
+them) and the only one that touches the journal. Workers keep resolving while it uploads.
+
+If the backfill is interrupted, what was added to the journal is resumed like any other upload,
+and running it again resolves the rest: lookups come from the cache/catalog, and plays that are
+already on trakt are skipped (see `dedupe` in config.ini).
+
+python coordinator.py movies [movie.txt] [workers]
+python coordinator.py structured [shows-structured.txt] [workers]
+"""
+
+import datetime as dt
+import multiprocessing
+import os
+import queue as queues
+import sys
+
+from typing import NamedTuple, Optional
+
+# third-party
+import trakt.core
+import tqdm
+
+# local
+import async_trakt
+import metrics
+import trakt_utils
+
+
+# default number of worker processes
+WORKERS = min(4, os.cpu_count() or 1)
+
+# lines (movies) or shows resolved by a worker before it sends them on
+CHUNK = 50
+
+# the writer uploads once this many plays are waiting
+FLUSH = 10 * trakt_utils.HISTORY_CHUNK
+
+
+class Item(NamedTuple):
+    """ what the journal needs of a movie or episode (trakt objects don't go through a queue) """
+    media_type: str  # "movies" or "episodes"
+    trakt: int
+    title: str  # the movie's, or the episode's show's
+    season: Optional[int] = None
+    number: Optional[int] = None
+
+
+def resolve_movies(lines):
+    """ yields ({Item: watched_at}, show trakt id, [lines left for review]) per chunk of lines """
+    import auto_match
+
+    for i in range(0, len(lines), CHUNK):
+        history, to_review = auto_match.match_movies(lines[i:i + CHUNK])
+        items = {Item("movies", media.trakt, media.title): watched_at for media, watched_at in history.items()}
+        yield items, None, to_review
+
+
+def resolve_structured(groups):
+    """
+    yields ({Item: watched_at}, show trakt id, [problems]) per line (a season listed more than once
+    is watched on each of its dates)
+    """
+    import interface
+    import title_index
+    import txt_tv_parser as ttp
+
+    # parsed and indexed once, not per chunk (shows that earlier chunks searched are in the cache)
+    years = ttp.debut_years()
+    index = title_index.TitleIndex(title_index.known_shows())
+    for i in range(0, len(groups), CHUNK):
+        lines = [(show, season, d) for show, seasons in groups[i:i + CHUNK] for season, d in seasons]
+        pending, problems = interface.resolve_structured(lines, years, index)
+        episodes = async_trakt.episodes_many(t for _, t, _ in pending)
+
+        for show, season, d in pending:
+            # TRAKT module - does not use timezone-aware datetimes
+            d = d + dt.timedelta(hours=interface.OFFSET)
+            items = {Item("episodes", e.trakt, show["title"], e.season, e.number): d for e in episodes[season]}
+            if items:
+                yield items, show["trakt"], []
+        if problems:
+            yield {}, None, problems
+
+
+RESOLVERS = {"movies": resolve_movies, "structured": resolve_structured}
+
+
+def worker(kind, shard, queue, share, base_url):
+    """ resolve `shard`, sending ("items", ...) messages and finally ("done", calls) or ("error", message) """
+    try:
+        # the same server as the coordinator's
+        trakt.core.BASE_URL = base_url
+        trakt_utils.auth_trakt(share=share, worker=True)
+        for items, show_trakt, skipped in RESOLVERS[kind](shard):
+            queue.put(("items", items, show_trakt, skipped))
+        queue.put(("done", metrics.REGISTRY.calls))
+    except Exception as e:
+        queue.put(("error", f"{type(e).__name__}: {e}"))
+
+
+def read_input(kind, fname=None):
+    """ the units of work: lines of the movie list, or (show, [(season, date)]) of shows-structured.txt """
+    if kind == "movies":
+        import auto_match
+        return auto_match.read_movies(fname or auto_match.MOVIES)
+
+    import txt_tv_parser as ttp
+    if fname:
+        ttp.STRUCTURED = fname
+    groups = {}
+    for show, season, d in ttp.get_structured():
+        groups.setdefault(show, []).append((season, d))
+    return list(groups.items())
+
+
+class History:
+    """
+    the user's history (see trakt_utils.existing_history) around the plays uploaded so far: it is
+    fetched at the first upload, for the dates of its batches, and only widened for later ones
+    """
+
+    def __init__(self, media_types, force=False):
+        self.media_types = media_types
+        self.force = force
+        self.index = None
+        self.dates = None  # (start, end) the index covers
+
+    def cover(self, start, end):
+        """ the index, fetched for the dates from `start` to `end` first where it doesn't cover them yet """
+        if self.dates is None:
+            self.index = trakt_utils.existing_history(start, end, self.media_types, force=self.force)
+            if self.index is not None:
+                self.dates = start, end
+            return self.index
+
+        lo, hi = self.dates
+        if start < lo:
+            self.index.update(trakt_utils.existing_history(start, lo, self.media_types, force=True))
+        if end > hi:
+            self.index.update(trakt_utils.existing_history(hi, end, self.media_types, force=True))
+        self.dates = min(start, lo), max(end, hi)
+        return self.index
+
+
+def upload(batches, history, bar):
+    """ send the batches through the journal. returns False if trakt could not be reached """
+    try:
+        dates = trakt_utils.get_journal().date_range(batches)
+        if not dates:
+            return True
+        for res in trakt_utils.upload_journal(batches, history.cover(*dates)):
+            bar.update(len(res.items))
+    except trakt_utils.UPLOAD_ERRORS as e:
+        bar.write(f"Error updating trakt ({type(e).__name__}), the rest is kept in the journal for the next run.")
+        return False
+    return True
+
+
+def coordinate(kind, units, workers=WORKERS):
+    """ resolve `units` in worker processes and upload the results from this one. returns the skipped lines """
+    shards = [units[i::workers] for i in range(workers) if units[i::workers]]
+    # the writer keeps a share of the GET limit for its own history checks
+    share = 1 / (len(shards) + 1)
+    trakt_utils.auth_trakt(share=share)
+    j = trakt_utils.get_journal()
+
+    # spawned (not forked) workers don't inherit our connections and threads
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    processes = [
+        ctx.Process(target=worker, args=(kind, shard, queue, share, trakt.core.BASE_URL), daemon=True)
+        for shard in shards
+    ]
+    for p in processes:
+        p.start()
+
+    online = not trakt_utils.offline()
+    # an upload that was interrupted in an earlier run is finished along the way
+    skipped, waiting = [], list(j.interrupted()) if online else []
+    # the user's history is fetched once for the dates that are uploaded (not for every upload),
+    # the uploads keep it up to date
+    media_types = sorted({"movies" if kind == "movies" else "episodes", *j.media_types(waiting)})
+    history = History(media_types, force=bool(waiting))
+    running = len(processes)
+    with tqdm.tqdm(desc="uploaded", unit=" plays") as bar:
+        while running:
+            try:
+                message = queue.get(timeout=1)
+            except queues.Empty:
+                if not any(p.is_alive() for p in processes):
+                    bar.write("the workers stopped without finishing, what they did not resolve is left for the next run")
+                    break
+                continue
+
+            if message[0] == "items":
+                _, items, show_trakt, lines = message
+                skipped.extend(lines)
+                if items:
+                    # every episode of a structured season is watched on its date
+                    waiting.append(j.append(items, show_trakt=show_trakt, whole=kind == "structured"))
+                    bar.total = (bar.total or 0) + len(items)
+                    bar.refresh()
+            elif message[0] == "done":
+                metrics.REGISTRY.merge(message[1])
+                running -= 1
+            else:
+                bar.write(f"a worker failed ({message[1]}), what it did not resolve is left for the next run")
+                running -= 1
+
+            if online and j.count_pending(waiting) >= FLUSH:
+                online = upload(waiting, history, bar)
+                waiting = []
+
+        if online and waiting:
+            upload(waiting, history, bar)
+
+    for p in processes:
+        p.join()
+    return skipped
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0] not in RESOLVERS:
+        print(__doc__)
+        sys.exit(1)
+
+    kind = args[0]
+    fname = next((a for a in args[1:] if not a.isdigit()), None)
+    workers = next((int(a) for a in args[1:] if a.isdigit()), WORKERS)
+
+    units = read_input(kind, fname)
+    skipped = coordinate(kind, units, workers)
+
+    if kind == "movies":
+        import auto_match
+        with open(auto_match.REVIEW, "w") as f:
+            for line in skipped:
+                f.write(line)
+                f.write("\n")
+        print(f"{len(skipped)} movies left for review in {auto_match.REVIEW}")
+    else:
+        for line in skipped:
+            print(line)
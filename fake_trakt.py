@@ -0,0 +1,390 @@
+#! /usr/bin/env python3
+
+"""
+Local stand-in for the parts of the trakt API this project uses, for benchmarks and for trying
+things out without a trakt account:
+
+- search (shows and movies)
+- show seasons and season episodes
+- updated shows
+- movie releases
+- sync/history (GET and POST)
+- OAuth (pin and device flows, any code is accepted)
+
+The catalog is generated: "Show 0" ... "Show n" with `seasons` seasons of `episodes` episodes
+each, and "Movie 0" ... "Movie n". Latency, rate limits and error injection are configurable.
+
+python fake_trakt.py [port]   # then set trakt.core.BASE_URL to the printed url
+"""
+
+import datetime
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# local
+import cache
+import rate_limit
+
+
+# trakt ids of generated movies start here (so they never collide with shows/episodes)
+MOVIE_IDS = 10_000_000
+
+TOKEN = {
+    "access_token": "fake-access-token",
+    "refresh_token": "fake-refresh-token",
+    "token_type": "bearer",
+    "scope": "public",
+    "expires_in": 90 * 24 * 60 * 60,
+}
+
+
+class FakeTrakt:
+    def __init__(
+            self, shows=100, seasons=5, episodes=20, movies=100,
+            latency=0.0, get_limit=rate_limit.GET_LIMIT, post_limit=rate_limit.POST_LIMIT,
+            error_rate=0.0, error_status=503, seed=0,
+    ):
+        self.shows = shows
+        self.seasons = seasons
+        self.episodes = episodes
+        self.movies = movies
+
+        # seconds added to every response
+        self.latency = latency
+        # (limit, period) as in rate_limit; requests over the limit get a 429 with Retry-After
+        self.limits = {
+            "GET": rate_limit.TokenBucket(*get_limit),
+            "POST": rate_limit.TokenBucket(*post_limit),
+        }
+        # share of requests (0-1) that fail with error_status
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        # (media type, trakt id) -> watched_at strings
+        self.history = {}
+        # show number -> when it was last updated on "trakt" (see update_show)
+        self.updated = {}
+        # requests served, by (method, endpoint)
+        self.requests = Counter()
+        # tcp connections opened by clients (requests on kept-alive connections don't count)
+        self.connections = 0
+
+        self.server = None
+
+        self.titles = {cache.normalize(f"Show {i}"): ("show", i) for i in range(shows)}
+        self.titles.update({cache.normalize(f"Movie {i}"): ("movie", i) for i in range(movies)})
+
+    # ---- generated catalog
+
+    def show(self, i):
+        return {"title": f"Show {i}", "year": 2000 + i % 20, "ids": {"trakt": i + 1, "slug": f"show-{i}"}}
+
+    def movie(self, i):
+        return {"title": f"Movie {i}", "year": 1980 + i % 40, "ids": {"trakt": MOVIE_IDS + i, "slug": f"movie-{i}"}}
+
+    def season(self, show, number):
+        return {
+            "number": number,
+            "ids": {"trakt": (show + 1) * 1000 + number},
+            "title": f"Season {number}",
+            "episode_count": self.episodes,
+            "first_aired": self.aired(show, number, 1),
+        }
+
+    def episode(self, show, season, number):
+        return {
+            "season": season,
+            "number": number,
+            "title": f"Episode {number}",
+            "ids": {"trakt": self.episode_id(show, season, number)},
+            "first_aired": self.aired(show, season, number),
+        }
+
+    def episode_id(self, show, season, number):
+        return ((show + 1) * 1000 + season) * 1000 + number
+
+    def decode_episode(self, trakt_id):
+        """ (show, season, number) of a generated episode id, or None """
+        rest, number = divmod(trakt_id, 1000)
+        show, season = divmod(rest, 1000)
+        if 0 < show <= self.shows and 0 < season <= self.seasons and 0 < number <= self.episodes:
+            return show - 1, season, number
+        return None
+
+    def aired(self, show, season, number):
+        d = datetime.date(2000 + show % 20, 1, 1) + datetime.timedelta(days=365 * (season - 1) + 7 * (number - 1))
+        return f"{d.isoformat()}T00:00:00.000Z"
+
+    def update_show(self, show, when=None):
+        """ list `show` as updated (now, by default) in shows/updates """
+        when = when or datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            self.updated[show] = f"{when:%Y-%m-%dT%H:%M:%S}.{when.microsecond // 1000:03d}Z"
+
+    def slug(self, slug, kind):
+        m = re.fullmatch(rf"{kind}-(\d+)", slug)
+        limit = self.shows if kind == "show" else self.movies
+        if m and int(m.group(1)) < limit:
+            return int(m.group(1))
+        return None
+
+    # ---- endpoints, each returns (status, body)
+
+    def search(self, params, media_type):
+        query = cache.normalize(params.get("query", ""))
+        found = self.titles.get(query)
+        results = []
+        if found and found[0] == media_type:
+            media = self.show(found[1]) if media_type == "show" else self.movie(found[1])
+            results.append({"type": media_type, "score": 1000, media_type: media})
+        return 200, results
+
+    def show_seasons(self, params, slug):
+        show = self.slug(slug, "show")
+        if show is None:
+            return 404, {}
+        return 200, [self.season(show, n) for n in range(1, self.seasons + 1)]
+
+    def season_episodes(self, params, slug, number):
+        show = self.slug(slug, "show")
+        if show is None or not 0 < int(number) <= self.seasons:
+            return 404, {}
+        return 200, [self.episode(show, int(number), n) for n in range(1, self.episodes + 1)]
+
+    def updated_shows(self, params, start):
+        page = int(params.get("page", 1))
+        limit = int(params.get("limit", 10))
+        with self.lock:
+            updated = sorted((when, show) for show, when in self.updated.items() if when >= start)
+        items = [
+            {"updated_at": when, "show": self.show(show)}
+            for when, show in updated[(page - 1) * limit:page * limit]
+        ]
+        return 200, items
+
+    def releases(self, params, slug, country):
+        movie = self.slug(slug, "movie")
+        if movie is None:
+            return 404, {}
+        release = {
+            "country": country,
+            "certification": "PG",
+            "release_date": f"{1980 + movie % 40}-06-01",
+            "release_type": "theatrical",
+            "note": None,
+        }
+        return 200, [release]
+
+    def get_history(self, params, media_type):
+        start = params.get("start_at", "")
+        end = params.get("end_at", "9999")
+        page = int(params.get("page", 1))
+        limit = int(params.get("limit", 10))
+
+        kind = media_type[:-1]
+        with self.lock:
+            plays = sorted(
+                (watched_at, trakt_id)
+                for (t, trakt_id), dates in self.history.items() if t == media_type
+                for watched_at in dates if start <= watched_at <= end
+            )
+
+        items = [
+            {"id": i, "watched_at": watched_at, "action": "watch", "type": kind, kind: {"ids": {"trakt": trakt_id}}}
+            for i, (watched_at, trakt_id) in enumerate(plays[(page - 1) * limit:page * limit])
+        ]
+        return 200, items
+
+    def post_history(self, params, body):
+        added = Counter()
+        not_found = {"movies": [], "shows": [], "seasons": [], "episodes": []}
+
+        def add(media_type, trakt_id, watched_at):
+            with self.lock:
+                self.history.setdefault((media_type, trakt_id), []).append(watched_at)
+            added[media_type] += 1
+
+        def add_season(show, season, watched_at):
+            for n in range(1, self.episodes + 1):
+                add("episodes", self.episode_id(show, season, n), watched_at)
+
+        now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        for item in body.get("movies", []):
+            trakt_id = item.get("ids", {}).get("trakt", 0)
+            if 0 <= trakt_id - MOVIE_IDS < self.movies:
+                add("movies", trakt_id, item.get("watched_at", now))
+            else:
+                not_found["movies"].append(item)
+
+        for item in body.get("episodes", []):
+            trakt_id = item.get("ids", {}).get("trakt", 0)
+            if self.decode_episode(trakt_id):
+                add("episodes", trakt_id, item.get("watched_at", now))
+            else:
+                not_found["episodes"].append(item)
+
+        for item in body.get("seasons", []):
+            show, season = divmod(item.get("ids", {}).get("trakt", 0), 1000)
+            if 0 < show <= self.shows and 0 < season <= self.seasons:
+                add_season(show - 1, season, item.get("watched_at", now))
+            else:
+                not_found["seasons"].append(item)
+
+        for item in body.get("shows", []):
+            show = item.get("ids", {}).get("trakt", 0) - 1
+            if not 0 <= show < self.shows:
+                not_found["shows"].append(item)
+                continue
+            watched_at = item.get("watched_at", now)
+            seasons = item.get("seasons") or [{"number": n} for n in range(1, self.seasons + 1)]
+            for season in seasons:
+                if 0 < season.get("number", 0) <= self.seasons:
+                    add_season(show, season["number"], season.get("watched_at", watched_at))
+                else:
+                    not_found["seasons"].append(season)
+
+        return 201, {"added": {"movies": added["movies"], "episodes": added["episodes"]}, "not_found": not_found}
+
+    def oauth_token(self, params, body):
+        return 200, dict(TOKEN, created_at=int(time.time()))
+
+    def device_code(self, params, body):
+        return 200, {
+            "device_code": "fake-device-code",
+            "user_code": "FAKE1234",
+            "verification_url": self.url + "activate",
+            "expires_in": 600,
+            "interval": 1,
+        }
+
+    ROUTES = [
+        ("GET", r"search/(show|movie)", search),
+        ("GET", r"shows/updates/([^/]+)", updated_shows),
+        ("GET", r"shows/([^/]+)/seasons", show_seasons),
+        ("GET", r"shows/([^/]+)/seasons/(\d+)", season_episodes),
+        ("GET", r"movies/([^/]+)/releases/(\w+)", releases),
+        ("GET", r"sync/history/(movies|episodes)", get_history),
+        ("POST", r"sync/history", post_history),
+        ("POST", r"oauth/token", oauth_token),
+        ("POST", r"oauth/device/code", device_code),
+        ("POST", r"oauth/device/token", oauth_token),
+    ]
+
+    def handle(self, method, path, body=None):
+        """ (status, json body, headers) for a request """
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urllib.parse.urlsplit(path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        route = url.path.strip("/")
+
+        for route_method, pattern, endpoint in self.ROUTES:
+            m = re.fullmatch(pattern, route)
+            if route_method == method and m:
+                break
+        else:
+            return 404, {}, {}
+
+        with self.lock:
+            self.requests[method, pattern] += 1
+
+        bucket = self.limits["GET" if method == "GET" else "POST"]
+        wait = bucket.take()
+        state = bucket.get_state()
+        headers = {"X-Ratelimit": json.dumps({
+            "name": f"AUTHED_API_{method}_LIMIT",
+            "period": state["period"],
+            "limit": state["limit"],
+            "remaining": max(int(state["tokens"]), 0),
+            "until": datetime.datetime.fromtimestamp(time.time() + wait, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })}
+        if wait > 0:
+            headers["Retry-After"] = str(max(1, round(wait)))
+            return 429, {}, headers
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.error_status, {}, headers
+
+        args = m.groups() if method == "GET" else (body or {},)
+        status, data = endpoint(self, params, *args)
+        return status, data, headers
+
+    # ---- http server
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self, port=0):
+        """ serve in a background thread. returns the base url (for trakt.core.BASE_URL) """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, like trakt
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately: don't let them wait on delayed acks
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with fake.lock:
+                    fake.connections += 1
+
+            def respond(self, method, body=None):
+                status, data, headers = fake.handle(method, self.path, body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length)
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    # form encoded (pin oauth flow)
+                    body = dict(urllib.parse.parse_qsl(raw.decode()))
+                self.respond("POST", body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+if __name__ == "__main__":
+    fake = FakeTrakt()
+    print(f"serving a fake trakt api on {fake.start(int(sys.argv[1]) if len(sys.argv) > 1 else 0)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
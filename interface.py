@@ -1,41 +1,79 @@
 #! /usr/bin/env python3
 
+from collections import deque
+import concurrent.futures
 import datetime as dt
-from itertools import zip_longest
-import json
+import importlib.util
+from itertools import islice
+import sys
 import time
 
 # third-party
-import tqdm
 from picotui.context import Context
 from picotui.screen import Screen
-from picotui.widgets import Dialog, WButton, WLabel, WCheckbox, WRadioButton, WTextEntry, WMultiEntry, WDropDown
-from picotui.widgets import ACTION_OK, ACTION_NEXT, ACTION_CANCEL
+from picotui.widgets import Dialog, WButton, WLabel, WRadioButton, WTextEntry, WMultiEntry, WDropDown
+from picotui.widgets import ACTION_OK, ACTION_NEXT, ACTION_PREV, ACTION_CANCEL
 from picotui.defs import C_WHITE, C_BLUE
 
 # local
-import trakt_utils
 import txt_tv_parser as ttp
-from picotui_ext import WPager, WEpisodeWidget
+from picotui_ext import WCheckList, WEpisodePager, WRecordCheckbox
 from picotui_ext import EP_WATCHED
 
 
+def lazy_import(name):
+    """
+    module `name`, imported only when it is first used - so the menu comes up (and "select shows"
+    runs) without importing trakt, requests and tqdm at all
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# only needed once a trakt path is chosen
+tqdm = lazy_import("tqdm")
+async_trakt = lazy_import("async_trakt")
+trakt_utils = lazy_import("trakt_utils")
+planner = lazy_import("planner")
+
+
 # use a manual offset, since trakt module incorrectly uses utc time instead of local time
 # (correct for daylight savings if necessary)
 OFFSET = time.timezone // 3600 - (time.localtime().tm_isdst > 0)
 
-
-def take_filled(iterable, n):
-    args = [iter(iterable)] * n
-    return zip_longest(*args)
+# default number of upcoming shows to look up while the user is busy with the current one
+PREFETCH = 3
 
 
-def take(iterable, n):
+def prefetch(fn, items, depth):
+    """
+    yield (item, future of fn(item)) in order, while keeping the next `depth` items
+    running in the background on a pool of `depth` workers
+    """
+    if depth < 1:
+        for item in items:
+            f = concurrent.futures.Future()
+            f.set_result(fn(item))
+            yield item, f
+        return
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=depth)
     try:
-        g = next(take_filled(iterable, n))
-        yield list(filter(lambda e: e is not None, g))
-    except StopIteration:
-        return []
+        itr = iter(items)
+        pending = deque((item, pool.submit(fn, item)) for item in islice(itr, depth + 1))
+        while pending:
+            item, future = pending.popleft()
+            for upcoming in islice(itr, 1):
+                pending.append((upcoming, pool.submit(fn, upcoming)))
+            yield item, future
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
 
 def redraw_screen():
@@ -45,73 +83,132 @@ def redraw_screen():
 
 
 # wrapper widget to paginate multiple items and allow multi-selection.
-# only allows "next"/"done" (no "previous")
+# allows "prev"/"next", and jumping to the first item of a year (for items from ttp.find_movies)
+# items are only read from `itr` as far as they are displayed, and kept in `records`
 # access results with Paginate.selected after completion
 # (assumes all items are unique, order is not retained)
 class Paginate:
     def __init__(self, itr):
-        self.selected = set()
-        self.itr = itr
-        self.page = 1
+        self.itr = iter(itr)
+        self.records = []
+        # selection state, indexed by record number
+        self.checked = bytearray()
+        # number of the first record of each year read so far
+        self.years = {}
+        self.page = 0
+
+    @property
+    def selected(self):
+        return {self.records[i] for i, c in enumerate(self.checked) if c}
+
+    def _read(self, n):
+        """ read from itr until there are n records. returns False if itr ran out first """
+        for record in islice(self.itr, max(0, n - len(self.records))):
+            try:
+                self.years.setdefault(int(record.split(" - ", 1)[0]), len(self.records))
+            except ValueError:
+                pass
+            self.records.append(record)
+            self.checked.append(0)
+        return len(self.records) >= n
+
+    def _year_start(self, year):
+        """ number of the first record from `year` (or later), reading ahead as needed """
+        exhausted = False
+        while True:
+            later = [idx for y, idx in self.years.items() if y >= year]
+            if later or exhausted:
+                return min(later, default=None)
+            exhausted = not self._read(len(self.records) + 1000)
 
     def run(self):
         def checkbox_changed(w):
-            if w.choice:
-                self.selected.update([w.t])
-            else:
-                if w.t in self.selected:
-                    self.selected.remove(w.t)
+            self.checked[w.idx] = w.choice
+
+        if not self._read(1):
+            return
 
         with Context():
-            while True:
-                redraw_screen()
-                x, y = Screen.screen_size()
-                d = Dialog(0, 0, x, y)
+            redraw_screen()
+            x, y = Screen.screen_size()
+            d = Dialog(0, 0, x, y)
 
-                try:
-                    # leave space for next/curr page labels
-                    results = next(take(self.itr, y - 4))
+            # leave space for next/curr page labels
+            # the same checkboxes are reused for every page
+            page_size = y - 4
+            rows = [WRecordCheckbox(x - 2) for _ in range(page_size)]
+            for idx, w_checkbox in enumerate(rows):
+                d.add(1, idx + 1, w_checkbox)
+                w_checkbox.on("changed", checkbox_changed)
 
-                    for idx, show in enumerate(results):
-                        w_checkbox = WCheckbox(show)
-                        d.add(1, idx + 1, w_checkbox)
+            w_page = WLabel("", w=10)
+            d.add(1, y - 2, w_page)
 
-                        w_checkbox.on("changed", checkbox_changed)
+            b = WButton(8, "Prev")
+            d.add(12, y - 2, b)
+            b.finish_dialog = ACTION_PREV
 
-                    b = WLabel(f"Page {self.page}")
-                    d.add(1, y - 2, b)
+            b = WButton(8, "Next")
+            d.add(21, y - 2, b)
+            b.finish_dialog = ACTION_NEXT
 
-                    b = WButton(8, "Next")
-                    d.add(12, y - 2, b)
-                    b.finish_dialog = ACTION_NEXT
+            b = WButton(8, "Done")
+            d.add(30, y - 2, b)
+            b.finish_dialog = ACTION_CANCEL
 
-                    b = WButton(8, "Done")
-                    d.add(23, y - 2, b)
-                    b.finish_dialog = ACTION_CANCEL
+            d.add(40, y - 2, "Go to year:")
+            w_year = WTextEntry(6, "")
+            d.add(52, y - 2, w_year)
+            w_year.finish_dialog = 1004
 
-                    res = d.loop()
+            while True:
+                start = self.page * page_size
+                has_next = self._read(start + page_size + 1)
 
-                    if res == ACTION_NEXT:
-                        self.page += 1
-                    elif res == ACTION_CANCEL:
-                        Screen.cls()
-                        return
+                for idx, w_checkbox in enumerate(rows, start):
+                    if idx < len(self.records):
+                        w_checkbox.set_record(idx, self.records[idx], bool(self.checked[idx]))
                     else:
-                        print(res)
-                        raise Exception(res)
+                        w_checkbox.set_record(None)
+                w_page.t = f"Page {self.page + 1}"
+
+                res = d.loop()
 
-                except StopIteration:
+                if res == ACTION_NEXT:
+                    if has_next:
+                        self.page += 1
+                elif res == ACTION_PREV:
+                    self.page = max(0, self.page - 1)
+                elif res == 1004:
+                    try:
+                        idx = self._year_start(int(w_year.get()))
+                        if idx is not None:
+                            self.page = idx // page_size
+                    except ValueError:
+                        pass
+                elif res == ACTION_CANCEL:
                     Screen.cls()
                     return
+                else:
+                    print(res)
+                    raise Exception(res)
 
 
 class SeasonSelector:
-    def __init__(self, show):
+    def __init__(self, show, lookup=None):
         self.show = show
         self.show_choice = None
 
+        # (optional) future with the prefetched results of trakt_utils.lookup_tv(show)
+        self.lookup = lookup
+        # search trakt even if the show was matched locally
+        self.search = False
+
     def run(self):
-        shows = trakt_utils.search_tv(self.show)
+        if self.lookup is not None:
+            shows = self.lookup.result()
+        else:
+            shows = trakt_utils.search_tv(self.show, local=not self.search)
 
         with Context():
             redraw_screen()
@@ -156,8 +253,19 @@ class SeasonSelector:
             d.add(16, y - 2, b_done)
             b_done.finish_dialog = ACTION_CANCEL
 
+            # the show was matched locally (without searching): a wrong match can be searched for
+            if not self.search and trakt_utils.prematched(self.show):
+                b_search = WButton(14, "Search trakt")
+                d.add(30, y - 2, b_search)
+                b_search.finish_dialog = 1007
+
             res = d.loop()
 
+        if res == 1007:
+            self.lookup = None
+            self.search = True
+            return self.run()
+
         if res == ACTION_OK:
             self.show_choice = shows[w_radio.choice]
 
@@ -172,15 +280,13 @@ class EpisodeSelector:
     def __init__(self, title, season):
         self.title = title
         self.season = season
-        self.episodes = season.episodes
+        self.episodes = trakt_utils.season_episodes(season)
 
         # fill out in run()
         self.results = {}
 
     def run(self):
-        episodes = list(map(WEpisodeWidget, self.episodes))
-
-        if not episodes:
+        if not self.episodes:
             return ACTION_CANCEL
 
         with Context():
@@ -235,7 +341,7 @@ class EpisodeSelector:
             d.add(1 + x // 2, 19, w_skip_show)
             w_skip_show.finish_dialog = ACTION_NEXT
 
-            w_pager = WPager(y - 5, episodes, d, offset=1)
+            w_pager = WEpisodePager(y - 5, self.episodes, d, x // 2 - 3, offset=1)
             d.add(1, 3, w_pager)
 
             res = d.loop()
@@ -243,31 +349,39 @@ class EpisodeSelector:
         get_dd = lambda i: int(w_dates[i].items[w_dates[i].choice])
 
         if res in [ACTION_OK, 1004]:
-            for w_ep in w_pager.items:
-                if w_ep.choice == int(EP_WATCHED.AIRED) or res == 1004:
+            for ep, choice in zip(self.episodes, w_pager.choices):
+                if choice == int(EP_WATCHED.AIRED) or res == 1004:
                     # datetime.datetime object
-                    self.results[w_ep.ep] = w_ep.ep.first_aired_date
-                elif w_ep.choice == int(EP_WATCHED.DATE):
+                    self.results[ep] = ep.first_aired_date
+                elif choice == int(EP_WATCHED.DATE):
                     d = dt.datetime(year=get_dd(0), month=get_dd(1), day=get_dd(2))
                     # TRAKT module - does not use timezone-aware datetimes
                     d = d + dt.timedelta(hours=OFFSET)
-                    self.results[w_ep.ep] = d
+                    self.results[ep] = d
         elif res in [1005, 1006]:
-            for w_ep in w_pager.items:
-                if res == 1006 or w_ep.choice != int(EP_WATCHED.SKIP):
+            for ep, choice in zip(self.episodes, w_pager.choices):
+                if res == 1006 or choice != int(EP_WATCHED.SKIP):
                     d = dt.datetime(year=get_dd(0), month=get_dd(1), day=get_dd(2))
                     # TRAKT module - does not use timezone-aware datetimes
                     d = d + dt.timedelta(hours=OFFSET)
-                    self.results[w_ep.ep] = d
+                    self.results[ep] = d
 
         return res
 
 
 class StructuredUpdate:
-    def __init__(self, show, trakt_season, date):
-        self.show = show
-        self.trakt_season = trakt_season
-        self.date = date
+    """
+    One review screen for every season in shows-structured.txt, before anything is posted.
+    `pending` is a list of (show, trakt season, date), `episodes` maps each season to its episodes.
+    """
+
+    def __init__(self, pending, episodes, problems):
+        self.pending = pending
+        self.episodes = episodes
+        self.problems = problems
+
+        # fill out in run()
+        self.selected = []
 
     def run(self):
         with Context():
@@ -276,8 +390,9 @@ class StructuredUpdate:
 
             d = Dialog(0, 0, x, y)
 
-            d.add(1, 1, f"Confirm: {self.show['title']}, Season {self.trakt_season.number}")
-            d.add(1, 2, f"> watched all episodes on {self.date}")
+            n_eps = sum(len(self.episodes[t]) for _, t, _ in self.pending)
+            d.add(1, 1, f"Confirm: {len(self.pending)} seasons ({n_eps} episodes) from {ttp.STRUCTURED}")
+            d.add(1, 2, "> every episode of a checked season is watched on its date (space toggles)")
 
             w_ok = WButton(4, "OK")
             w_ok.finish_dialog = ACTION_OK
@@ -287,17 +402,21 @@ class StructuredUpdate:
             w_cancel.finish_dialog = ACTION_CANCEL
             d.add(10, 4, w_cancel)
 
-            sd = list(trakt_utils.display_seasons(self.show["seasons"]))
-            w_showinfo = WMultiEntry(x // 2 - 2, 3 * y // 4 - 1, sd)
-            d.add(1, y // 4, w_showinfo)
+            rows = [
+                f"{date.strftime('%Y/%m/%d')}  {show['title']} - Season {t.number} ({len(self.episodes[t])} episodes)"
+                for show, t, date in self.pending
+            ]
+            w_seasons = WCheckList(x // 2 - 2, y - 8, rows)
+            d.add(1, 6, w_seasons)
 
-            ep_print = lambda e: f"E{e.number:>02}: {e.title} ({e.first_aired_date})"
-            eps = list(map(ep_print, self.trakt_season.episodes))
-            w_epinfo = WMultiEntry(x // 2 - 2, 3 * y // 4 - 1, eps)
-            d.add(1 + x // 2, y // 4, w_epinfo)
+            if self.problems:
+                d.add(1 + x // 2, 5, f"Skipped {len(self.problems)} lines:")
+                w_problems = WMultiEntry(x // 2 - 2, y - 8, self.problems)
+                d.add(1 + x // 2, 6, w_problems)
 
             res = d.loop()
 
+        self.selected = [p for p, checked in zip(self.pending, w_seasons.checked) if checked]
         return res == ACTION_OK
 
 
@@ -313,23 +432,36 @@ def select_watched_shows():
     ttp.serialize(p.selected)
 
 
-def episode_updates(results):
-    # unholy combination of TUI + tqdm ???
-    try:
-        [trakt_utils.non_interactive_episode_add(*e) for e in tqdm.tqdm(results.items())]
-    except json.decoder.JSONDecodeError:
-        ep = list(results.keys())[0]
-        print(f"Error updating: {ep.show} - Season {ep.season}")
-        print("You may have to reset progress for this show/season in trakt and redo this season.")
-        print("skipping.")
-        time.sleep(2)
+def report_sync(bar, res):
+    bar.update(len(res.items))
+    if res.skipped:
+        bar.write(f"{res.skipped} of {len(res.items)} episodes are already in your history, skipped")
+    if res.not_found:
+        bar.write(f"{res.not_found} of {len(res.items)} episodes were not found on trakt")
+
+
+def episode_updates(results, show_trakt=None, whole=False):
+    """
+    upload {episode: watched_at} through the journal: every chunk is marked as sent once trakt
+    confirms it, so if the upload is interrupted, the next run resumes it where it stopped.
+    `whole`: `results` is every episode of the season on one date, which is sent as a single season
+    """
+    if results:
+        batch = trakt_utils.get_journal().append(results, show_trakt=show_trakt, whole=whole)
+        journal_updates([batch])
 
 
 def update_trakt(defer):
     tv_shows = list(ttp.get_selected())
-
-    for show in tv_shows:
-        s = SeasonSelector(show)
+    # offline, every selection is kept for later
+    defer = defer or trakt_utils.offline()
+    # shows that are already known locally are not searched on trakt
+    trakt_utils.prematch_shows(tv_shows, ttp.debut_years())
+    depth = trakt_utils.get_config().getint("interface", "prefetch", fallback=PREFETCH)
+
+    # look up the next few shows on trakt while the user is selecting seasons/episodes
+    for show, lookup in prefetch(trakt_utils.lookup_tv, tv_shows, depth):
+        s = SeasonSelector(show, lookup)
         ret = s.run()
 
         # skip this season on ACTION_NEXT
@@ -344,11 +476,13 @@ def update_trakt(defer):
                 res = ep.run()
 
                 if res in [ACTION_OK, 1004, 1005, 1006]:
+                    # every episode on the input date: one season instead of one object per episode
+                    whole = res == 1006
                     if defer:
                         if ep.results:
-                            trakt_utils.bad_serializer(ep.results)
+                            trakt_utils.get_journal().append(ep.results, show_trakt=s.show_choice["trakt"], whole=whole)
                     else:
-                        episode_updates(ep.results)
+                        episode_updates(ep.results, show_trakt=s.show_choice["trakt"], whole=whole)
                 elif res == ACTION_CANCEL:
                     # skipping this season
                     pass
@@ -359,43 +493,138 @@ def update_trakt(defer):
                     raise Exception(res)
 
 
+def journal_updates(batches, existing=None):
+    """ upload `batches` of the journal. `existing`: the user's history, if it was fetched already """
+    if trakt_utils.offline():
+        print(f"Offline: {trakt_utils.get_journal().count_pending(batches)} updates are kept in the journal,")
+        print("run trakt updates from a previous run once offline is turned off in config.ini.")
+        time.sleep(2)
+        return
+
+    try:
+        with tqdm.tqdm(total=trakt_utils.get_journal().count_pending(batches)) as bar:
+            for res in trakt_utils.upload_journal(batches, existing):
+                report_sync(bar, res)
+    except trakt_utils.UPLOAD_ERRORS as e:
+        print(f"Error updating trakt ({type(e).__name__}).")
+        print("Entries that were not sent yet are kept, and sent when you run this script again.")
+        time.sleep(2)
+
+
+def resume_uploads():
+    """ finish uploads that were interrupted (crash, network error, ctrl-c) in an earlier run """
+    batches = trakt_utils.get_journal().interrupted()
+    if batches:
+        print(f"Resuming {trakt_utils.get_journal().count_pending(batches)} updates that were interrupted in an earlier run")
+        journal_updates(batches)
+
+
 def deferred_updates():
-    print("The serialized file is NOT removed between runs.")
-    print("This will result in deuplicate plays of episodes if you re-run deferred updates.")
-    print("Make sure to delete serialized.pickle after successful updates.")
+    print("Episodes are marked as sent once trakt accepts them,")
+    print("so re-running deferred updates only sends the remaining ones.")
+    print()
+
+    # collect every confirmed season first so they can be sent in a few bulk requests
+    batches = []
+    for batch, show, season, count in trakt_utils.get_journal().batches():
+        print(f"> {show} - Season {season} ({count} episodes)")
+        answer = input("Run update for this show/season?: [Y/n]")
+        if answer.strip().lower() == "y" or not answer.strip():
+            batches.append(batch)
+
+    if batches:
+        planned_updates(batches)
+    else:
+        print("Nothing to update. Run a deferred update first.")
+
+
+def planned_updates(batches):
+    """ show what uploading `batches` of the journal will cost (see planner.py), and upload them if the user agrees """
+    j = trakt_utils.get_journal()
+    dates = j.date_range(batches)
+    if trakt_utils.offline() or not dates:
+        journal_updates(batches)
+        return
+
+    # the history the upload skips plays with, fetched once for the report and the upload
+    try:
+        existing = trakt_utils.existing_history(
+            *dates, j.media_types(batches), force=bool(set(j.interrupted()).intersection(batches))
+        )
+    except trakt_utils.UPLOAD_ERRORS as e:
+        print(f"Error reading your history from trakt ({type(e).__name__}).")
+        print("The updates are kept, and sent when you run trakt updates from a previous run.")
+        time.sleep(2)
+        return
+
+    # planning adds the planned plays to the history it is given
+    plan = planner.make_plan(batches, None if existing is None else set(existing), merge=existing is not None)
     print()
-    for d in trakt_utils.read_serialized():
-        try:
-            ep = list(d.items())[0][0]
-            print(f"> {ep.show} - Season {ep.season} ({ep.first_aired_date})")
-            answer = input("Run update for this show/season?: [Y/n]")
-            if answer.strip().lower() == "y" or not answer.strip():
-                episode_updates(d)
-        except IndexError:
-            pass
+    print(planner.report(plan))
+    answer = input("Upload now?: [Y/n]")
+    if answer.strip() and answer.strip().lower() != "y":
+        print("The updates are kept, run trakt updates from a previous run to send them later.")
+        return
+    journal_updates(batches, existing)
 
 
-def structured_updates():
-    for show_s, season, d in ttp.get_structured():
-        trakt_shows = trakt_utils.search_tv(show_s)
-
-        try:
-            # assume results[0] is correct
-            trakt_season = next(filter(lambda t: t.number == season, trakt_shows[0]["seasons"]))
-
-            s = StructuredUpdate(trakt_shows[0], trakt_season, d)
-            if s.run():
-                # TRAKT module - does not use timezone-aware datetimes
-                d = d + dt.timedelta(hours=OFFSET)
-                episode_updates({e: d for e in trakt_season.episodes})
-        except StopIteration:
-            print(f"No result for season {season} in {trakt_shows[0]} ({len(trakt_shows[0]['seasons'])} seasons)")
+def resolve_structured(lines, years=None, index=None):
+    """
+    group the lines of shows-structured.txt by show, so each show is looked up once (all concurrently)
+    `years` and `index` are passed to prematch_shows (default: ttp.debut_years() and the known shows)
+    returns ([(show, trakt season, date)], [lines that could not be resolved])
+    """
+    groups = {}
+    for show_s, season, d in lines:
+        groups.setdefault(show_s, []).append((season, d))
+
+    trakt_utils.prematch_shows(groups, ttp.debut_years() if years is None else years, index)
+    lookups = async_trakt.lookup_tv_many(groups)
+
+    pending, problems = [], []
+    for show_s, seasons in groups.items():
+        if not lookups[show_s]:
+            problems.append(f"No results for {show_s}")
             continue
 
+        # assume results[0] is correct
+        show = lookups[show_s][0]
+        by_number = {t.number: t for t in show["seasons"]}
+        for season, d in seasons:
+            if season in by_number:
+                pending.append((show, by_number[season], d))
+            else:
+                problems.append(f"No result for season {season} in {show['title']} ({len(by_number)} seasons)")
+
+    return pending, problems
+
+
+def structured_updates():
+    pending, problems = resolve_structured(ttp.get_structured())
+    if not pending and not problems:
+        return
+
+    episodes = async_trakt.episodes_many(t for _, t, _ in pending)
+
+    s = StructuredUpdate(pending, episodes, problems)
+    if not s.run():
+        return
+
+    # one batch per line: a season listed more than once (a rewatch) is marked watched on each date.
+    # every selected season goes in one bulk upload, each one sent as a season (with the show's
+    # other seasons in one show object) instead of episode by episode
+    j = trakt_utils.get_journal()
+    batches = []
+    for show, trakt_season, d in s.selected:
+        # TRAKT module - does not use timezone-aware datetimes
+        d = d + dt.timedelta(hours=OFFSET)
+        if episodes[trakt_season]:
+            batches.append(j.append({e: d for e in episodes[trakt_season]}, show_trakt=show["trakt"], whole=True))
+    if batches:
+        planned_updates(batches)
 
-def main():
-    trakt_utils.auth_trakt()
 
+def main():
     with Context():
         redraw_screen()
         x, y = Screen.screen_size()
@@ -439,6 +668,15 @@ def main():
     if res == 1:
         select_watched_shows()
     elif res == 2:
+        # "select shows" never talks to trakt, so only authenticate here
+        trakt_utils.auth_trakt()
+        if not trakt_utils.offline():
+            try:
+                trakt_utils.refresh_catalog()
+            except trakt_utils.UPLOAD_ERRORS as e:
+                print(f"Could not check trakt for updated shows ({type(e).__name__}), using the catalog as it is.")
+            resume_uploads()
+
         if defer == 1004:
             deferred_updates()
         elif defer == 1005:
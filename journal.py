@@ -0,0 +1,162 @@
+"""
+Append-only journal of pending trakt history updates.
+
+Replaces serialized.pickle: instead of full trakt objects, each watched movie/episode is stored
+as a compact row (trakt ids, season/number, watched_at) in a sqlite database (JOURNAL).
+Every call to `Journal.append` (e.g. one season selected in interface.py) is a "batch".
+
+Rows are read back in order and in small pages, so they can be streamed into the uploader,
+and are marked as sent once trakt confirms them - re-running an upload only sends what is left.
+Batches whose upload was started are remembered too, so an upload that was interrupted
+(crash, network error, ctrl-c) can be found and resumed by the next run.
+"""
+
+import datetime as dt
+import sqlite3
+
+from typing import Iterable, List, NamedTuple, Optional
+
+
+JOURNAL = "journal.sqlite"
+
+# rows fetched per query while streaming pending entries
+PAGE = 500
+
+
+class Entry(NamedTuple):
+    id: int
+    batch: int
+    media_type: str  # "episodes" or "movies" (as in trakt objects' media_type)
+    trakt: int
+    show: Optional[str]
+    show_trakt: Optional[int]
+    season: Optional[int]
+    number: Optional[int]
+    watched_at: dt.datetime
+    whole: bool = False  # every episode of its season is in the batch, watched at the same time
+
+    @property
+    def ids(self):
+        # same shape as trakt.tv.TVEpisode.ids / trakt.movies.Movie.ids
+        return {"ids": {"trakt": self.trakt}}
+
+
+class Journal:
+    def __init__(self, path=JOURNAL):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " id INTEGER PRIMARY KEY, batch INTEGER NOT NULL, media_type TEXT NOT NULL,"
+                " trakt INTEGER NOT NULL, show TEXT, show_trakt INTEGER, season INTEGER, number INTEGER,"
+                " watched_at TEXT NOT NULL, sent INTEGER NOT NULL DEFAULT 0)"
+            )
+            # journals from before whole seasons were recorded
+            if "whole" not in [r[1] for r in self.conn.execute("PRAGMA table_info(entries)")]:
+                self.conn.execute("ALTER TABLE entries ADD COLUMN whole INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_pending ON entries (sent, batch, id)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS uploads (batch INTEGER PRIMARY KEY)")
+
+    def append(self, results, show_trakt=None, whole=False) -> int:
+        """
+        add {media: watched_at} (trakt.tv.TVEpisode or trakt.movies.Movie keys) as a new batch.
+        `whole`: the episodes are every episode of their seasons, each season watched at one time
+        (so it can be sent as a season instead of episode by episode).
+        returns the batch number
+        """
+        with self.conn:
+            batch = self.conn.execute("SELECT COALESCE(MAX(batch), 0) + 1 FROM entries").fetchone()[0]
+            self.conn.executemany(
+                "INSERT INTO entries (batch, media_type, trakt, show, show_trakt, season, number, watched_at, whole)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        batch, media.media_type, media.trakt,
+                        getattr(media, "show", None) or getattr(media, "title", None), show_trakt,
+                        getattr(media, "season", None), getattr(media, "number", None),
+                        watched_at.isoformat(), whole,
+                    )
+                    for media, watched_at in results.items()
+                ],
+            )
+        return batch
+
+    def _where(self, batches):
+        if batches is None:
+            return "sent = 0", []
+        batches = list(batches)
+        return f"sent = 0 AND batch IN ({', '.join('?' * len(batches))})", batches
+
+    def batches(self):
+        """ yields (batch, show, season, count) for every batch with unsent entries """
+        yield from self.conn.execute(
+            "SELECT batch, MIN(show), MIN(season), COUNT(*) FROM entries WHERE sent = 0"
+            " GROUP BY batch ORDER BY batch"
+        ).fetchall()
+
+    def count_pending(self, batches=None) -> int:
+        where, args = self._where(batches)
+        return self.conn.execute(f"SELECT COUNT(*) FROM entries WHERE {where}", args).fetchone()[0]
+
+    def date_range(self, batches=None):
+        """ (earliest, latest) watched_at of the unsent entries, or None """
+        where, args = self._where(batches)
+        lo, hi = self.conn.execute(f"SELECT MIN(watched_at), MAX(watched_at) FROM entries WHERE {where}", args).fetchone()
+        if lo is None:
+            return None
+        return dt.datetime.fromisoformat(lo), dt.datetime.fromisoformat(hi)
+
+    def media_types(self, batches=None):
+        where, args = self._where(batches)
+        return [r[0] for r in self.conn.execute(f"SELECT DISTINCT media_type FROM entries WHERE {where}", args)]
+
+    def pending(self, batches=None) -> Iterable[Entry]:
+        """ stream unsent entries (optionally only from `batches`) in the order they were added """
+        where, args = self._where(batches)
+        last = 0
+        while True:
+            rows = self.conn.execute(
+                f"SELECT id, batch, media_type, trakt, show, show_trakt, season, number, watched_at, whole"
+                f" FROM entries WHERE {where} AND id > ? ORDER BY id LIMIT ?",
+                args + [last, PAGE],
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield Entry(*row[:-2], dt.datetime.fromisoformat(row[-2]), bool(row[-1]))
+            last = rows[-1][0]
+
+    def _select(self, columns, where, ids):
+        ids = list(ids)
+        rows = []
+        for i in range(0, len(ids), PAGE):
+            page = ids[i:i + PAGE]
+            rows.extend(self.conn.execute(
+                f"SELECT {columns} FROM entries WHERE {where} AND id IN ({', '.join('?' * len(page))})", page
+            ))
+        return sorted(rows)
+
+    def entries(self, ids) -> List[Entry]:
+        """ the entries with these ids (sent or not), in the order they were added """
+        rows = self._select("id, batch, media_type, trakt, show, show_trakt, season, number, watched_at, whole", "1", ids)
+        return [Entry(*row[:-2], dt.datetime.fromisoformat(row[-2]), bool(row[-1])) for row in rows]
+
+    def unsent(self, ids) -> List[int]:
+        """ those of `ids` that were not sent yet """
+        return [row[0] for row in self._select("id", "sent = 0", ids)]
+
+    def start_upload(self, batches=None):
+        """ remember that the unsent entries of `batches` (default: all) are being uploaded """
+        where, args = self._where(batches)
+        with self.conn:
+            self.conn.execute(f"INSERT OR IGNORE INTO uploads SELECT DISTINCT batch FROM entries WHERE {where}", args)
+
+    def interrupted(self):
+        """ batches whose upload was started but that still have unsent entries """
+        return [r[0] for r in self.conn.execute(
+            "SELECT DISTINCT batch FROM entries WHERE sent = 0 AND batch IN (SELECT batch FROM uploads) ORDER BY batch"
+        )]
+
+    def mark_sent(self, ids):
+        with self.conn:
+            self.conn.executemany("UPDATE entries SET sent = 1 WHERE id = ?", [(i,) for i in ids])
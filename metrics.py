@@ -0,0 +1,222 @@
+#! /usr/bin/env python3
+
+"""
+In-process registry of trakt API calls, to see where the time of a run went.
+
+Every request sent through `rate_limit.RateLimitedSession` is recorded with its endpoint
+(e.g. `GET shows/:slug/seasons/:n`), latency, status, number of retries and the time spent
+waiting on the rate limiter. `summary()` aggregates them (call counts, p50/p95 latency, and how
+much of the run's wall time was spent waiting vs in requests); with `install()` the summary is
+written to METRICS when the process exits.
+
+Requests can run concurrently, so the shares of wall time are computed from the time intervals
+in which at least one request was in flight / at least one caller was waiting, not from sums.
+
+python metrics.py   # print the summary of the last run
+"""
+
+import atexit
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from typing import Dict, List, NamedTuple, Tuple
+
+
+METRICS = "metrics.json"
+
+# path segments that follow these are ids/slugs
+ID_PARENTS = {"shows", "movies", "people", "seasons", "episodes", "lists", "users"}
+
+# path segments that are part of the api itself (e.g. shows/updates/:date, not shows/:slug/...)
+STATIC = {
+    "aliases", "all", "anticipated", "boxoffice", "calendars", "certifications", "checkin", "code",
+    "collected", "collection", "comments", "countries", "device", "episode", "favorites", "genres",
+    "hidden", "history", "id", "languages", "last_activities", "last_episode", "list", "movie", "my",
+    "networks", "next_episode", "pause", "person", "played", "playback", "popular", "progress",
+    "ratings", "recommended", "related", "releases", "remove", "scrobble", "search", "settings",
+    "show", "start", "stats", "stop", "studios", "summary", "sync", "token", "translations",
+    "trending", "updates", "watched", "watching", "watchlist",
+}
+
+# e.g. 2024-01-31T20:00:00.000Z, or 2024-01-31
+DATE = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+
+class Call(NamedTuple):
+    latency: float  # seconds spent in requests (all attempts)
+    status: int  # status of the last attempt
+    retries: int
+    wait: float  # seconds spent waiting on the rate limiter (all attempts)
+
+
+def endpoint(method, url):
+    """
+    "GET https://api.trakt.tv/shows/lost-2004/seasons/1?extended=full" -> "GET shows/:slug/seasons/:n".
+    ids, slugs, dates and anything else that is not part of the api are replaced, so there is a
+    bounded number of endpoints
+    """
+    parts = urllib.parse.urlsplit(url).path.strip("/").split("/")
+    for i in range(1, len(parts)):
+        if parts[i] in ID_PARENTS or parts[i] in STATIC:
+            continue
+        if parts[i].isdigit():
+            parts[i] = ":n"
+        elif DATE.match(parts[i]):
+            parts[i] = ":date"
+        elif parts[i - 1] in ID_PARENTS:
+            parts[i] = ":slug"
+        else:
+            parts[i] = ":id"
+    return f"{method.upper()} {'/'.join(parts)}"
+
+
+def covered(spans) -> float:
+    """ total length of the union of (start, end) intervals """
+    total = 0.0
+    end = float("-inf")
+    for s, e in sorted(spans):
+        if e > end:
+            total += e - max(s, end)
+            end = e
+    return total
+
+
+def percentile(values, p):
+    """ nearest-rank percentile of a sorted list """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+class Registry:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.calls: Dict[str, List[Call]] = {}
+        # (start, end) of every request attempt, and of every wait on the rate limiter
+        self.request_spans: List[Tuple[float, float]] = []
+        self.wait_spans: List[Tuple[float, float]] = []
+        self.started = clock()
+
+    def record(self, method, url, status, retries=0, request_spans=(), wait_spans=()):
+        """ one call to `url`: the spans are (start, end) times from self.clock, one per attempt """
+        call = Call(
+            sum(e - s for s, e in request_spans), status, retries,
+            sum(e - s for s, e in wait_spans),
+        )
+        key = endpoint(method, url)
+        with self.lock:
+            self.calls.setdefault(key, []).append(call)
+            self.request_spans.extend(request_spans)
+            self.wait_spans.extend(wait_spans)
+
+    def merge(self, calls: Dict[str, List[Call]]):
+        """ add the calls recorded by another process (their time spans can't be compared with ours) """
+        with self.lock:
+            for key, values in calls.items():
+                self.calls.setdefault(key, []).extend(Call(*c) for c in values)
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.request_spans = []
+            self.wait_spans = []
+            self.started = self.clock()
+
+    def summary(self):
+        with self.lock:
+            calls = {key: list(values) for key, values in self.calls.items()}
+            request_spans = list(self.request_spans)
+            wait_spans = list(self.wait_spans)
+            wall = self.clock() - self.started
+
+        endpoints = {}
+        for key, values in sorted(calls.items()):
+            latencies = sorted(c.latency for c in values)
+            statuses = {}
+            for c in values:
+                statuses[str(c.status)] = statuses.get(str(c.status), 0) + 1
+            endpoints[key] = {
+                "calls": len(values),
+                "statuses": statuses,
+                "retries": sum(c.retries for c in values),
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "total": sum(latencies),
+                "wait": sum(c.wait for c in values),
+            }
+
+        # time with at least one request in flight
+        requests = covered(request_spans)
+        # time spent only waiting: no request in flight, but someone waiting on the rate limiter
+        waiting = covered(request_spans + wait_spans) - requests
+        return {
+            "wall": wall,
+            "calls": sum(e["calls"] for e in endpoints.values()),
+            "requests": requests,
+            "waiting": waiting,
+            # everything else: our own code, and the user in interactive runs
+            "other": max(wall - requests - waiting, 0.0),
+            "endpoints": endpoints,
+        }
+
+    def save(self, path=METRICS):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def format_summary(summary):
+    wall = summary["wall"] or 1.0
+    lines = [
+        f"{summary['calls']} trakt calls in {summary['wall']:.1f}s:"
+        f" {summary['requests']:.1f}s in requests ({summary['requests'] / wall:.0%}),"
+        f" {summary['waiting']:.1f}s waiting on rate limits ({summary['waiting'] / wall:.0%}),"
+        f" {summary['other']:.1f}s other ({summary['other'] / wall:.0%})",
+        f"{'endpoint':<40} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'retries':>8} {'wait s':>8}  statuses",
+    ]
+    for key, e in summary["endpoints"].items():
+        statuses = ", ".join(f"{status}: {n}" for status, n in sorted(e["statuses"].items()))
+        lines.append(
+            f"{key:<40} {e['calls']:>6} {e['p50'] * 1000:>8.0f} {e['p95'] * 1000:>8.0f}"
+            f" {e['retries']:>8} {e['wait']:>8.1f}  {statuses}"
+        )
+    return "\n".join(lines)
+
+
+# the registry shared by every flow in this process
+REGISTRY = Registry()
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def install(path=METRICS, echo=False):
+    """ write the summary of this process' calls to `path` (and print it, if `echo`) at exit. safe to call more than once """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        _installed = True
+
+    def report():
+        if not REGISTRY.calls:
+            return
+        REGISTRY.save(path)
+        if echo:
+            print(format_summary(REGISTRY.summary()))
+
+    atexit.register(report)
+
+
+if __name__ == "__main__":
+    fname = sys.argv[1] if len(sys.argv) > 1 else METRICS
+    if not os.path.exists(fname):
+        print(f"no {fname} yet - it is written at the end of each run")
+        sys.exit(1)
+    with open(fname) as f:
+        print(format_summary(json.load(f)))
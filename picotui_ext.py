@@ -6,7 +6,7 @@ from enum import IntEnum
 from typing import List
 from picotui.widgets import Widget, Dialog
 
-from picotui.widgets import ItemSelWidget, FocusableWidget
+from picotui.widgets import ItemSelWidget, FocusableWidget, WCheckbox, WListBox
 
 from picotui.defs import C_B_BLUE, C_GREEN, C_B_GREEN
 from picotui.defs import KEY_UP, KEY_DOWN, KEY_ENTER, DOWN_ARROW, KEY_TAB, KEY_SHIFT_TAB
@@ -15,14 +15,31 @@ from picotui.widgets import ACTION_OK
 UP_ARROW = chr(8593)
 
 
+class _Blank(Widget):
+    """ placeholder for an unused slot of WPager """
+
+    def __init__(self):
+        super().__init__()
+        self.x = self.y = self.w = self.h = 0
+
+    def redraw(self):
+        pass
+
+
 class WPager(ItemSelWidget):
     """
+    Scrollable list of widgets, of which only the window that fits in `h` rows is displayed.
+
+    The displayed widgets occupy a fixed pool of slots in the parent dialog's children:
+    scrolling shifts the window just enough to show the selected item (i.e. by one item per
+    key press) and rebinds the slots, and only rows that changed are redrawn.
+
     possible todo: "scrollbar" indicating position in multi-paged output
     """
 
     def __init__(self, h: int, widgets: List[Widget], parent_dialog: Dialog, offset=0):
         super().__init__(widgets)
-        self.w = max(w.w for w in widgets) + 2
+        self.w = self._width()
         self.h = h
         self.offset = offset
 
@@ -34,53 +51,101 @@ class WPager(ItemSelWidget):
         self.parent_handle_key = self.parent.handle_key
         self.parent.handle_key = self.handle_key
 
-        self.displayed: List[Widget] = []
-        self.reorder(start=0)
+        # indices of the displayed items
+        self.displayed: List[int] = self._window_from(0)
+
+        # positions in parent.childs reserved for the displayed widgets (claimed on first redraw),
+        # and what each slot showed when it was last drawn: (item index, y)
+        self.slots: List[int] = []
+        self.drawn: List = []
+        # first row below the displayed widgets
+        self.bottom = 0
+
+    # subclasses that do not keep one widget per item override these
+    def _width(self):
+        return max(w.w for w in self.items) + 2
+
+    def _height(self, i):
+        return self.items[i].h
 
-    def reorder(self, start=None, end=None):
-        itr = None
-        if start is not None and start < len(self.items):
-            itr = range(self.choice, len(self.items))
-        if end is not None and end < len(self.items):
-            # itr = range(len(self.items) - 1, 0, -1)
-            itr = range(end, 0, -1)
-        assert itr is not None
+    def _widget(self, slot, i):
+        """ the widget showing item `i` in the given slot """
+        return self.items[i]
 
+    def _window_from(self, start):
+        """ indices of the items that fit, starting at `start` """
+        shown = []
         height = 0
-        self.displayed = []
-        for i in itr:
-            if height + self.items[i].h <= self.h:
-                if start is not None:
-                    # counting up
-                    self.displayed.append(i)
-                else:
-                    # counting down
-                    self.displayed.insert(0, i)
-                height += self.items[i].h + self.offset
-            else:
+        for i in range(start, len(self.items)):
+            if height + self._height(i) > self.h:
                 break
+            shown.append(i)
+            height += self._height(i) + self.offset
+        return shown
+
+    def _window_to(self, end):
+        """ indices of the items that fit, ending at `end` """
+        shown = []
+        height = 0
+        for i in range(end, -1, -1):
+            if height + self._height(i) > self.h:
+                break
+            shown.insert(0, i)
+            height += self._height(i) + self.offset
+        return shown
+
+    def _scroll(self):
+        if self.choice < self.displayed[0]:
+            self.displayed = self._window_from(self.choice)
+        elif self.choice > self.displayed[-1]:
+            self.displayed = self._window_to(self.choice)
+
+    def _bind_slots(self):
+        """ put the displayed widgets into our slots. returns the slots whose content changed """
+        childs = self.parent.childs
+        while len(self.slots) < len(self.displayed):
+            self.slots.append(len(childs))
+            self.drawn.append(None)
+            blank = _Blank()
+            blank.owner = self.parent
+            childs.append(blank)
+
+        changed = []
+        y = self.y
+        for k, pos in enumerate(self.slots):
+            if k < len(self.displayed):
+                wi = self.displayed[k]
+                w = self._widget(k, wi)
+                w.set_xy(self.x + 2, y)
+                w.owner = self.parent
+                childs[pos] = w
+                state = (wi, y)
+                y += w.h + self.offset
+            else:
+                childs[pos] = _Blank()
+                state = None
+
+            if self.drawn[k] != state:
+                self.drawn[k] = state
+                changed.append(k)
+
+        self.bottom = y - self.offset
+        return changed
 
-    def _remove_from_dialog(self, wi):
-        if self.items[wi] in self.parent.childs:
-            self.parent.childs.remove(self.items[wi])
+    def _chosen(self):
+        """ the widget showing the selected item """
+        k = self.displayed.index(self.choice)
+        return self._widget(k, self.choice)
 
     def _inside(self):
         if self.focus:
             return True
-        if self.parent.focus_w in self.items:
+        # only the displayed widgets can have the focus
+        if any(self.parent.childs[pos] is self.parent.focus_w for pos in self.slots):
             return True
         return False
 
-    def redraw(self):
-        # can be optimized by using a shifting window instead of re-calculating whole thing
-        for wi in self.displayed:
-            self._remove_from_dialog(wi)
-
-        if self.choice < self.displayed[0]:
-            self.reorder(start=self.choice)
-        if self.choice > self.displayed[-1]:
-            self.reorder(end=self.choice)
-
+    def _draw_gutter(self):
         if self.displayed[0] > 0:
             self.goto(self.x, self.y)
             self.wr(UP_ARROW)
@@ -93,34 +158,21 @@ class WPager(ItemSelWidget):
                 self.attr_reset()
 
         shade = C_B_GREEN if self._inside() else C_GREEN
-
-        i = self.y
+        self.attr_color(shade, None)
+        y = self.y
         for wi in self.displayed:
-            for x in range(0, self.items[wi].h):
-                self.goto(self.x + 1, i + x)
-                self.attr_color(shade, None)
-                if self.choice == wi:
-                    self.wr(">")
-                else:
-                    self.wr("|")
-                self.attr_reset()
-
-            if wi != self.displayed[-1] or True:
-                for x in range(0, self.offset):
-                    self.goto(self.x + 1, i + x + self.items[wi].h)
-                    self.attr_color(shade, None)
-                    self.wr("|")
-                    self.attr_reset()
-
-            if wi == self.displayed[-1]:
-                for y in range(i + x + self.items[wi].h, self.y + self.h):
-                    self.goto(self.x + 1, y + 1)
-                    self.attr_color(shade, None)
-                    self.wr("|")
-                    self.attr_reset()
-
-            self.parent.add(self.x + 2, i, self.items[wi])
-            i += self.items[wi].h + self.offset
+            for dy in range(self._height(wi)):
+                self.goto(self.x + 1, y + dy)
+                self.wr(">" if self.choice == wi else "|")
+            y += self._height(wi)
+            for dy in range(self.offset):
+                self.goto(self.x + 1, y + dy)
+                self.wr("|")
+            y += self.offset
+        for y in range(y, self.y + self.h + 1):
+            self.goto(self.x + 1, y)
+            self.wr("|")
+        self.attr_reset()
 
         if self.displayed[-1] < len(self.items) - 1:
             self.goto(self.x, self.y + self.h)
@@ -128,12 +180,27 @@ class WPager(ItemSelWidget):
         else:
             if self.focus:
                 self.attr_color(C_B_BLUE, None)
-            # self.goto(self.x, self.h - self.y - 1)
             self.goto(self.x, self.y + self.h)
             self.wr("-")
             if self.focus:
                 self.attr_reset()
 
+    def redraw(self):
+        self._scroll()
+        changed = self._bind_slots()
+
+        self._draw_gutter()
+
+        if changed:
+            # clear whatever is left below the last displayed widget
+            for y in range(self.bottom, self.y + self.h + 1):
+                self.goto(self.x + 2, y)
+                self.wr(" " * (self.w - 2))
+
+            for k in changed:
+                if k < len(self.displayed):
+                    self.parent.childs[self.slots[k]].redraw()
+
     def handle_key(self, key):
         if key in [KEY_UP, KEY_DOWN]:
             if self.focus_w != self.choice:
@@ -149,32 +216,31 @@ class WPager(ItemSelWidget):
             pass
         elif key == KEY_ENTER:
             self.focus_w = self.choice
-            self.parent.change_focus(self.items[self.choice])
+            self.parent.change_focus(self._chosen())
             self.signal("changed")
         elif key == KEY_TAB:
             if self.focus_w is None:
                 self.focus_w = self.choice
-                self.parent.change_focus(self.items[self.choice])
+                self.parent.change_focus(self._chosen())
                 return
 
             if self.choice < len(self.items) - 1:
+                # move_sel() scrolls and redraws the rows that changed
                 self.move_sel(1)
                 self.focus_w = self.choice
-                self.parent.change_focus(self.items[self.choice])
-                self.parent.redraw()
+                self.parent.change_focus(self._chosen())
             else:
                 return self.parent_handle_key(key)
         elif key == KEY_SHIFT_TAB:
             if self.focus_w is None:
                 self.focus_w = self.choice
-                self.parent.change_focus(self.items[self.choice])
+                self.parent.change_focus(self._chosen())
                 return
 
             if self.choice > 0:
                 self.move_sel(-1)
                 self.focus_w = self.choice
-                self.parent.change_focus(self.items[self.choice])
-                self.parent.redraw()
+                self.parent.change_focus(self._chosen())
         else:
             return self.parent_handle_key(key)
 
@@ -200,49 +266,117 @@ class WPager(ItemSelWidget):
                 return w.handle_mouse(x, y)
 
 
+class WRecordCheckbox(WCheckbox):
+    """
+    Checkbox that is reused for different records (e.g. on every page of a paginated list).
+    `idx` is the number of the record currently shown, or None for an empty row.
+    """
+
+    def __init__(self, w):
+        super().__init__("")
+        self.w = w
+        self.idx = None
+
+    def set_record(self, idx, title="", choice=False):
+        self.idx = idx
+        self.t = title
+        self.choice = choice
+
+    def redraw(self):
+        self.goto(self.x, self.y)
+        if self.idx is None:
+            self.wr(" " * self.w)
+            return
+
+        if self.focus:
+            self.attr_color(C_B_BLUE, None)
+        self.wr("[x] " if self.choice else "[ ] ")
+        self.wr(self.t[:self.w - 4].ljust(self.w - 4))
+        self.attr_reset()
+
+    def flip(self):
+        if self.idx is not None:
+            super().flip()
+
+
+class WCheckList(WListBox):
+    """
+    Scrollable list of checkboxes, one per line of `items`.
+    The states are kept in `checked` (one byte per item), space toggles the current line.
+    """
+
+    def __init__(self, w, h, items, checked=True):
+        self.checked = bytearray([checked]) * len(items)
+        super().__init__(w, h, items)
+
+    def show_line(self, l, i):
+        if i != -1:
+            l = ("[x] " if self.checked[i] else "[ ] ") + l
+        super().show_line(l, i)
+
+    def handle_edit_key(self, key):
+        if key == b" " and self.items:
+            self.checked[self.cur_line] ^= 1
+
+
 class EP_WATCHED(IntEnum):
     SKIP = 0
     AIRED = 1
     DATE = 2
 
 
-class WEpisodeWidget(ItemSelWidget):
+EP_CHOICES = [
+    "Skipped",
+    "Watched on Air Date",
+    "Input Date",
+]
+
+
+class WEpisodeRow(ItemSelWidget):
     """
     Custom widget to display choosing when an episode was watched.
+
+    One of these is drawn per visible row of a WEpisodePager and is re-bound to whichever
+    episode scrolls into it: the choices themselves live in the pager's `choices` array.
     """
 
-    def __init__(self, ep):
-        self.ep = ep
-        self.header = [
-            f"Episode {self.ep.number} ({self.ep.first_aired_date})",
-            f"Title: {self.ep.title}",
-        ]
-        items = [
-            "Skipped",
-            "Watched on Air Date",
-            "Input Date",
-        ]
-        super().__init__(items)
-        self.h = 5
-        self.w = max(
-            max(len(s) for s in self.header),
-            6 + max(len(s) for s in items),
-        )
+    def __init__(self, episodes, choices: bytearray, w: int):
+        self.episodes = episodes
+        self.choices = choices
+        # index of the episode shown, None while unbound
+        self.idx = None
+        super().__init__(EP_CHOICES)
+        self.h = 2 + len(EP_CHOICES)
+        self.w = w
         self.focus = False
 
+    @property
+    def choice(self):
+        return 0 if self.idx is None else self.choices[self.idx]
+
+    @choice.setter
+    def choice(self, value):
+        if self.idx is not None:
+            self.choices[self.idx] = value
+
+    @property
+    def ep(self):
+        return self.episodes[self.idx]
+
+    def _line(self, s):
+        self.wr(s[:self.w].ljust(self.w))
+
     def redraw(self):
-        i = 0
         if self.focus:
             self.attr_color(C_B_BLUE, None)
+        # headers are only formatted for the episodes on screen
         self.goto(self.x, self.y)
-        self.wr(f"Episode {self.ep.number} ({self.ep.first_aired_date})")
+        self._line(f"Episode {self.ep.number} ({self.ep.first_aired_date})")
         self.goto(self.x, self.y + 1)
-        self.wr(f"Title: {self.ep.title}")
-        for t in self.items:
+        self._line(f"Title: {self.ep.title}")
+        for i, t in enumerate(self.items):
             self.goto(self.x, self.y + i + 2)
-            self.wr("  (*) " if self.choice == i else "  ( ) ")
-            self.wr(t)
-            i += 1
+            self._line(("  (*) " if self.choice == i else "  ( ) ") + t)
         self.attr_reset()
 
     def handle_mouse(self, x, y):
@@ -259,3 +393,29 @@ class WEpisodeWidget(ItemSelWidget):
         elif key == KEY_ENTER:
             # ?
             return ACTION_OK
+
+
+class WEpisodePager(WPager):
+    """
+    WPager over a list of episodes that does not create a widget per episode:
+    each episode's choice (EP_WATCHED) is one byte of `choices`, and only the visible
+    rows have a WEpisodeRow, which is re-bound as the list scrolls.
+    """
+
+    def __init__(self, h: int, episodes, parent_dialog: Dialog, w: int, offset=0):
+        self.choices = bytearray(len(episodes))
+        self.rows: List[WEpisodeRow] = []
+        self.row_w = w
+        super().__init__(h, episodes, parent_dialog, offset)
+
+    def _width(self):
+        return self.row_w + 2
+
+    def _height(self, i):
+        return 2 + len(EP_CHOICES)
+
+    def _widget(self, slot, i):
+        while len(self.rows) <= slot:
+            self.rows.append(WEpisodeRow(self.items, self.choices, self.row_w))
+        self.rows[slot].idx = i
+        return self.rows[slot]
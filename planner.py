@@ -0,0 +1,310 @@
+#! /usr/bin/env python3
+
+"""
+Plans an upload before anything is sent: what is pending in the journal (or a shows-structured.txt
+or movie list, which is resolved into the journal first) is turned into the requests the upload
+will make, and a dry-run report tells how many there are, how big they are and how long sending
+them will take.
+
+- a movie or episode that is pending more than once for the same day is sent once
+- plays that are already in the user's history are left out (with `existing`, see
+  trakt_utils.existing_history)
+- a season whose episodes were all watched at the same time is sent as one season of a show object,
+  instead of one object per episode: seasons that were added to the journal as a whole (e.g. "EACH
+  episode watched on input date", shows-structured.txt), and seasons whose episodes are all pending
+  (as known in the catalog). the seasons of a show go in one show object
+- objects are sent trakt_utils.HISTORY_CHUNK per request
+
+The wall time is estimated by playing the requests through the current rate limits (as saved in
+ratelimit.json) with the latency measured in earlier runs (metrics.json).
+
+A plan is saved as json (PLAN) and uploaded as it is by `run()`: its entries are marked as sent in
+the journal as each request is confirmed, so running it again (e.g. after an interruption) only
+sends the rest.
+
+python planner.py                     # plan everything that is pending in the journal
+python planner.py structured [file]   # add shows-structured.txt to the journal and plan it
+python planner.py movies [file]       # add a movie list (matched as in auto_match.py) and plan it
+python planner.py run [plan.json]     # upload a saved plan
+"""
+
+import datetime as dt
+import json
+import sys
+import time
+
+from typing import List, NamedTuple
+
+# third-party
+import trakt.utils
+
+# local
+import catalog
+import metrics
+import rate_limit
+import trakt_utils
+
+
+PLAN = "upload-plan.json"
+
+# seconds per request when no earlier run measured it
+LATENCY = 0.5
+
+
+class Request(NamedTuple):
+    payload: dict  # the body of a POST to sync/history
+    # per movie/episode it marks as watched: the journal ids of its entries (duplicates merged into it)
+    plays: List[List[int]]
+
+    @property
+    def entries(self) -> List[int]:
+        return [i for ids in self.plays for i in ids]
+
+
+class Plan(NamedTuple):
+    requests: List[Request]
+    skipped: List[int]  # journal ids of plays that are already in the user's history
+    merged: int  # duplicates that are not sent
+    seasons: int  # seasons that are sent as a single object
+
+
+def make_plan(batches=None, existing=None, merge=True, chunk_size=None) -> Plan:
+    """
+    plan the upload of the unsent entries of the journal (optionally only from `batches`).
+    `existing` is a history_index(): plays in it are left out, the planned ones are added to it.
+    without `merge`, a play that is pending more than once is sent as often.
+    `chunk_size` objects are sent per request (default: trakt_utils.HISTORY_CHUNK)
+    """
+    j = trakt_utils.get_journal()
+
+    # history key (or entry id, without merge) -> the entries of the play
+    plays, skipped, planned = {}, [], set()
+    # (show trakt id, season, watched_at) of the seasons that lost episodes that way
+    partial = set()
+    for e in j.pending(batches):
+        key = trakt_utils.history_key(e, e.watched_at)
+        if existing is not None and key in existing:
+            skipped.append(e.id)
+            partial.add((e.show_trakt, e.season, e.watched_at))
+            continue
+        plays.setdefault(key if merge else e.id, []).append(e)
+        planned.add(key)
+    if existing is not None:
+        existing.update(planned)
+
+    # episodes of the same season watched at the same time (of the same batch, without merge: a
+    # season that is pending more than once is sent as often)
+    groups = {}
+    for key, (e, *_) in plays.items():
+        if e.media_type == "episodes" and e.show_trakt is not None and e.season is not None:
+            groups.setdefault((e.show_trakt, e.season, e.watched_at, None if merge else e.batch), []).append(key)
+
+    # keys of the plays that are part of a whole season -> that season
+    whole = {}
+    lib = catalog.default()
+    for season, keys in groups.items():
+        show_trakt, number, watched_at, _ = season
+        if any(e.whole for k in keys for e in plays[k]):
+            # sending the season would also add the plays that were skipped
+            if (show_trakt, number, watched_at) not in partial:
+                whole.update((k, season) for k in keys)
+        elif len(keys) > 1 and lib.episode_ids(show_trakt, number) == {plays[k][0].trakt for k in keys}:
+            whole.update((k, season) for k in keys)
+
+    # (media type, object, [entry ids per play]), in the order the plays were added
+    objects, seen = [], set()
+    for key, entries in plays.items():
+        if key not in whole:
+            media_type, data = trakt_utils.history_item(entries[0], entries[0].watched_at)
+            objects.append((media_type, data, [[e.id for e in entries]]))
+            continue
+
+        season = whole[key]
+        if season in seen:
+            continue
+        seen.add(season)
+        show_trakt, number, watched_at, _ = season
+        keys = groups[season]
+        data = {"ids": {"trakt": show_trakt}, "seasons": [{"number": number, "watched_at": trakt.utils.timestamp(watched_at)}]}
+        objects.append(("shows", data, [[e.id for e in plays[k]] for k in keys]))
+
+    requests = []
+    for chunk in trakt_utils.chunks(objects, chunk_size or trakt_utils.HISTORY_CHUNK):
+        payload, shows = {}, {}
+        for media_type, data, _ in chunk:
+            if media_type != "shows":
+                payload.setdefault(media_type, []).append(data)
+            elif data["ids"]["trakt"] in shows:
+                # seasons of the same show go in one show object
+                shows[data["ids"]["trakt"]]["seasons"].extend(data["seasons"])
+            else:
+                shows[data["ids"]["trakt"]] = data
+                payload.setdefault("shows", []).append(data)
+        requests.append(Request(payload, [ids for *_, object_plays in chunk for ids in object_plays]))
+
+    merged = sum(len(entries) - 1 for entries in plays.values())
+    return Plan(requests, skipped, merged, len(seen))
+
+
+def latency(prefix) -> float:
+    """ the highest median latency of the endpoints starting with `prefix` in the last run (metrics.json) """
+    try:
+        with open(metrics.METRICS) as f:
+            endpoints = json.load(f)["endpoints"]
+    except (OSError, ValueError, KeyError):
+        return LATENCY
+    p50s = [e["p50"] for key, e in endpoints.items() if key.startswith(prefix) and e.get("calls")]
+    return max(p50s) if p50s else LATENCY
+
+
+def estimate(requests, method="POST", prefix="POST sync/history") -> float:
+    """ seconds it takes to send `requests` one after another, at the current rate limits """
+    clock = [time.time()]
+    limiter = rate_limit.RateLimiter(clock=lambda: clock[0])
+    limiter.load()
+    bucket = limiter.bucket(method)
+    seconds = latency(prefix)
+
+    start = clock[0]
+    for _ in range(requests):
+        clock[0] += max(bucket.reserve(), 0.0) + seconds
+    return clock[0] - start
+
+
+def report(plan: Plan, history_checks=0) -> str:
+    """
+    the dry-run report of `plan`. `history_checks` is the number of media types whose history is
+    looked up before the upload (one request each, at least)
+    """
+    plays = sum(len(r.plays) for r in plan.requests)
+    size = sum(len(json.dumps(r.payload)) for r in plan.requests)
+    seconds = estimate(len(plan.requests))
+    if history_checks:
+        seconds += estimate(history_checks, "GET", "GET sync/history")
+
+    lines = [
+        f"{plays} plays in {len(plan.requests)} requests to sync/history ({size:,} bytes)",
+        f"{plan.merged} duplicates merged, {len(plan.skipped)} plays already in your history,"
+        f" {plan.seasons} whole seasons sent as a single object",
+    ]
+    if history_checks:
+        lines.append(f"{history_checks}+ requests to check your history first")
+    lines.append(f"estimated time: {dt.timedelta(seconds=round(seconds))}")
+    return "\n".join(lines)
+
+
+def save(plan: Plan, path=PLAN):
+    with open(path, "w") as f:
+        json.dump({**plan._asdict(), "requests": [r._asdict() for r in plan.requests]}, f)
+
+
+def load(path=PLAN) -> Plan:
+    with open(path) as f:
+        data = json.load(f)
+    return Plan(**{**data, "requests": [Request(**r) for r in data["requests"]]})
+
+
+def run(plan: Plan, existing=None):
+    """
+    send the requests of `plan`, marking their entries as sent in the journal as each one is confirmed.
+    entries that were sent in the meantime (an earlier run of the plan) are left out, and so are plays
+    in `existing` (a history_index(), which the sent plays are added to). a request that loses some of
+    its plays this way is sent as single movies/episodes.
+    yields a trakt_utils.SyncResult per request
+    """
+    j = trakt_utils.get_journal()
+    entries = {e.id: e for e in j.entries([i for r in plan.requests for i in r.entries] + plan.skipped)}
+    j.start_upload(sorted({e.batch for e in entries.values()}))
+
+    ids = j.unsent(plan.skipped)
+    if ids:
+        j.mark_sent(ids)
+        yield trakt_utils.SyncResult([(entries[i], entries[i].watched_at) for i in ids], 0, 0, len(ids))
+
+    for request in plan.requests:
+        unsent = set(j.unsent(request.entries))
+        if not unsent:
+            continue
+        ids = [i for i in request.entries if i in unsent]
+        items = [(entries[i], entries[i].watched_at) for i in ids]
+
+        # the first unsent entry of each play that is left (a play is sent once, however many entries it has)
+        to_send, skipped = [], 0
+        for play in request.plays:
+            play = [i for i in play if i in unsent]
+            if not play:
+                continue
+            e = entries[play[0]]
+            if existing is not None and trakt_utils.history_key(e, e.watched_at) in existing:
+                skipped += len(play)
+                continue
+            to_send.append(e)
+        if existing is not None:
+            existing.update(trakt_utils.history_key(e, e.watched_at) for e in to_send)
+
+        payload = request.payload
+        if len(to_send) < len(request.plays):
+            payload = {}
+            for e in to_send:
+                media_type, data = trakt_utils.history_item(e, e.watched_at)
+                payload.setdefault(media_type, []).append(data)
+
+        result = (trakt_utils.post_history(payload) if payload else None) or {}
+        j.mark_sent(ids)
+        added = sum(result.get("added", {}).values())
+        not_found = sum(len(v) for v in result.get("not_found", {}).values())
+        yield trakt_utils.SyncResult(items, added, not_found, skipped)
+
+
+def add_input(kind, fname=None):
+    """ resolve a movie list or shows-structured.txt into new journal batches. returns (batches, skipped lines) """
+    import coordinator
+
+    j = trakt_utils.get_journal()
+    batches, skipped = [], []
+    for items, show_trakt, lines in coordinator.RESOLVERS[kind](coordinator.read_input(kind, fname)):
+        skipped.extend(lines)
+        if items:
+            # every episode of a season in shows-structured.txt is watched on its date
+            batches.append(j.append(items, show_trakt=show_trakt, whole=kind == "structured"))
+    return batches, skipped
+
+
+if __name__ == "__main__":
+    import tqdm
+
+    args = sys.argv[1:]
+    command = args[0] if args else ""
+    if command not in ("", "structured", "movies", "run"):
+        print(__doc__)
+        sys.exit(1)
+
+    trakt_utils.auth_trakt()
+    j = trakt_utils.get_journal()
+    dedupe = trakt_utils.get_config().getboolean("sync", "dedupe", fallback=True)
+
+    if command == "run":
+        if trakt_utils.offline():
+            print("offline is turned on in config.ini, nothing is uploaded")
+            sys.exit(1)
+        plan = load(args[1] if len(args) > 1 else PLAN)
+        entries = j.entries(i for r in plan.requests for i in r.entries)
+        existing = None
+        if dedupe and entries:
+            dates = min(e.watched_at for e in entries), max(e.watched_at for e in entries)
+            existing = trakt_utils.existing_history(*dates, sorted({e.media_type for e in entries}))
+        with tqdm.tqdm(total=len(entries), unit=" plays") as bar:
+            for res in run(plan, existing):
+                bar.update(len(res.items))
+        sys.exit(0)
+
+    batches = None
+    if command:
+        batches, skipped = add_input(command, args[1] if len(args) > 1 else None)
+        for line in skipped:
+            print(f"not added: {line}")
+
+    plan = make_plan(batches, merge=dedupe)
+    save(plan)
+    print(report(plan, len(j.media_types(batches)) if dedupe else 0))
+    print(f"saved to {PLAN}, upload it with: python planner.py run")
@@ -0,0 +1,280 @@
+"""
+Client-side rate limiting for trakt API calls.
+
+https://trakt.docs.apiary.io/#introduction/rate-limiting
+GET requests are limited to 1000 calls every 5 minutes,
+POST/PUT/DELETE requests to 1 call per second.
+
+Every request made through `RateLimitedSession` takes a token from the GET or POST bucket
+first. The buckets are corrected from the `X-Ratelimit` and `Retry-After` headers that trakt
+sends back, and their state is saved to STATE on exit so that a new run picks up where the
+last one left off.
+
+The session is also the one pooled, keep-alive connection pool for all trakt traffic, with
+default timeouts (see `RateLimitedSession`).
+
+This module does not depend on trakt itself, so a limiter can be pointed at any
+(e.g. local) server for testing.
+"""
+
+import atexit
+import datetime
+import json
+import os
+import threading
+import time
+
+# third-party
+import requests
+import requests.adapters
+
+# local
+import metrics
+
+
+STATE = "ratelimit.json"
+
+# defaults, until trakt tells us otherwise
+GET_LIMIT = (1000, 300)
+POST_LIMIT = (1, 1)
+
+# how many times a request is retried after a 429 response
+RETRIES = 3
+
+# kept-alive connections per host, and (connect, read) timeouts in seconds
+POOL_SIZE = 10
+TIMEOUT = (5, 30)
+
+
+class TokenBucket:
+    def __init__(self, limit, period, clock=time.time, share=1.0):
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        self.limit = limit
+        self.period = period
+        # part of the limit this bucket hands out (processes that split a limit between them)
+        self.share = share
+        self.tokens = float(limit) * share
+        self.updated = clock()
+        self.blocked_until = 0.0
+
+    @property
+    def rate(self):
+        return self.limit * self.share / self.period
+
+    def _refill(self, now):
+        self.tokens = min(self.limit * self.share, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """
+        take a token and return how long (in seconds) the caller has to wait before using it.
+        tokens may go negative, so concurrent callers queue up behind each other.
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def take(self) -> float:
+        """
+        take a token only if one is available (e.g. to enforce a limit server side).
+        returns 0 if a token was taken, otherwise how long (in seconds) until there is one
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            return 0.0
+
+    def update(self, limit, period, remaining, until=None):
+        """ correct this bucket with the values from an X-Ratelimit header """
+        with self.lock:
+            self._refill(self.clock())
+            self.limit = limit
+            self.period = period
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0 and until is not None:
+                self.blocked_until = max(self.blocked_until, until)
+
+    def block(self, seconds):
+        """ stop handing out tokens for `seconds` (e.g. from a Retry-After header) """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+    def get_state(self):
+        with self.lock:
+            self._refill(self.clock())
+            return {
+                "limit": self.limit,
+                "period": self.period,
+                "tokens": self.tokens,
+                "updated": self.updated,
+                "blocked_until": self.blocked_until,
+            }
+
+    def set_state(self, state):
+        with self.lock:
+            self.limit = state["limit"]
+            self.period = state["period"]
+            self.tokens = state["tokens"]
+            self.updated = state["updated"]
+            self.blocked_until = state["blocked_until"]
+            self._refill(self.clock())
+
+
+def parse_until(s):
+    # e.g. "2020-10-10T00:24:00Z"
+    try:
+        d = datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
+    except (TypeError, ValueError):
+        return None
+    return d.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class RateLimiter:
+    def __init__(self, clock=time.time, sleep=time.sleep, share=1.0):
+        """
+        `share`: the part of trakt's GET limit this limiter hands out, when several processes split it
+        (only one of them sends POSTs, see coordinator.py)
+        """
+        self.sleep = sleep
+        self.share = share
+        # the file the state is kept in across runs, if this process owns it (see install())
+        self.path = None
+        self.buckets = {
+            "GET": TokenBucket(*GET_LIMIT, clock=clock, share=share),
+            "POST": TokenBucket(*POST_LIMIT, clock=clock),
+        }
+
+    def bucket(self, method):
+        # PUT/DELETE count against the same limit as POST
+        return self.buckets["GET" if method.upper() in ["GET", "HEAD"] else "POST"]
+
+    def acquire(self, method) -> float:
+        """ block until a request with `method` may be sent. returns the time spent waiting """
+        wait = self.bucket(method).reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return max(wait, 0.0)
+
+    def update(self, method, response):
+        bucket = self.bucket(method)
+
+        header = response.headers.get("X-Ratelimit")
+        if header:
+            try:
+                info = json.loads(header)
+                bucket.update(
+                    int(info["limit"]), int(info["period"]), int(info["remaining"]),
+                    parse_until(info.get("until")),
+                )
+            except (ValueError, KeyError, TypeError):
+                pass
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1.0
+            bucket.block(retry_after)
+
+    def load(self, path=STATE):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            for name, bucket in self.buckets.items():
+                if name in state:
+                    bucket.set_state(state[name])
+        except (ValueError, KeyError, TypeError):
+            # corrupt state - start with full buckets
+            pass
+
+    def save(self, path=STATE):
+        state = {name: bucket.get_state() for name, bucket in self.buckets.items()}
+        with open(path, "w") as f:
+            json.dump(state, f)
+
+
+class RateLimitedSession(requests.Session):
+    """
+    `compress`: ask for compressed responses (gzip etc., the requests default)
+    requests without an explicit timeout get `timeout`
+    """
+
+    def __init__(self, limiter, retries=RETRIES, registry=metrics.REGISTRY,
+                 pool_size=POOL_SIZE, timeout=TIMEOUT, compress=True):
+        super().__init__()
+        self.limiter = limiter
+        self.retries = retries
+        # every request is recorded here (with its retries and time spent waiting)
+        self.registry = registry
+
+        self.timeout = timeout
+        # threads wait for a free connection instead of opening (and throwing away) extra ones
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        if not compress:
+            self.headers["Accept-Encoding"] = "identity"
+
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+
+        clock = self.registry.clock
+        attempt = 0
+        request_spans, wait_spans = [], []
+        while True:
+            start = clock()
+            if self.limiter.acquire(method) > 0:
+                wait_spans.append((start, clock()))
+
+            start = clock()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.RequestException:
+                request_spans.append((start, clock()))
+                self.registry.record(method, url, 0, attempt, request_spans, wait_spans)
+                raise
+            request_spans.append((start, clock()))
+            self.limiter.update(method, response)
+
+            if response.status_code != 429 or attempt >= self.retries:
+                self.registry.record(method, url, response.status_code, attempt, request_spans, wait_spans)
+                return response
+            attempt += 1
+
+
+_install_lock = threading.Lock()
+
+
+def install(core, path=STATE, share=1.0, **options):
+    """
+    route all requests made by the trakt library (`trakt.core`) through one rate limited session.
+    `options` are passed to RateLimitedSession (pool_size, timeout, compress).
+    without a `path` (worker processes) the state is neither loaded nor saved: that is left to the
+    process that starts them.
+    safe to call more than once.
+    """
+    with _install_lock:
+        if isinstance(core.session, RateLimitedSession):
+            return core.session
+
+        limiter = RateLimiter(share=share)
+        if path:
+            limiter.path = path
+            limiter.load(path)
+            atexit.register(limiter.save, path)
+
+        core.session = RateLimitedSession(limiter, **options)
+        return core.session
@@ -0,0 +1,203 @@
+import datetime as dt
+
+from typing import NamedTuple, Optional
+
+import pytest
+
+import catalog
+import journal
+import planner
+import trakt_utils
+
+
+D1 = dt.datetime(2020, 1, 1)
+D2 = dt.datetime(2020, 2, 1)
+SHOW = 7
+
+
+class Media(NamedTuple):
+    media_type: str
+    trakt: int
+    title: str = "Title"
+    season: Optional[int] = None
+    number: Optional[int] = None
+
+    @property
+    def ids(self):
+        return {"ids": {"trakt": self.trakt}}
+
+
+def movie(trakt):
+    return Media("movies", trakt)
+
+
+def episode(trakt, season=1, number=None):
+    return Media("episodes", trakt, "Show", season, number or trakt)
+
+
+class StubCatalog:
+    def __init__(self, seasons=None):
+        # (show trakt id, season) -> episode trakt ids
+        self.seasons = seasons or {}
+
+    def episode_ids(self, show_trakt, season):
+        return self.seasons.get((show_trakt, season))
+
+
+@pytest.fixture
+def j(tmp_path, monkeypatch):
+    j = journal.Journal(str(tmp_path / "journal.sqlite"))
+    monkeypatch.setattr(trakt_utils, "_journal", j)
+    monkeypatch.setattr(catalog, "_default", StubCatalog())
+    return j
+
+
+@pytest.fixture
+def posted(monkeypatch):
+    payloads = []
+
+    def post_history(payload):
+        payloads.append(payload)
+        return {"added": {"episodes": sum(1 for _ in payload.get("episodes", ()))}}
+
+    monkeypatch.setattr(trakt_utils, "post_history", post_history)
+    return payloads
+
+
+def history(*media, day=D1):
+    return {trakt_utils.history_key(m, day) for m in media}
+
+
+def test_duplicates_are_merged(j, posted):
+    j.append({movie(1): D1, movie(2): D1})
+    j.append({movie(1): D1})
+
+    plan = planner.make_plan()
+    assert plan.merged == 1
+    assert [len(r.plays) for r in plan.requests] == [2]
+    assert len(plan.requests[0].payload["movies"]) == 2
+
+    list(planner.run(plan))
+    assert len(posted) == 1
+    assert j.count_pending() == 0
+
+
+def test_duplicates_are_kept_without_merge(j, posted):
+    j.append({movie(1): D1})
+    j.append({movie(1): D1})
+
+    plan = planner.make_plan(merge=False)
+    assert plan.merged == 0
+    assert len(plan.requests[0].payload["movies"]) == 2
+
+    # checking the history rebuilds nothing: both plays are still sent
+    list(planner.run(plan, existing=set()))
+    assert len(posted[0]["movies"]) == 2
+
+
+def test_plays_in_history_are_skipped(j, posted):
+    j.append({movie(1): D1, movie(2): D1})
+
+    existing = history(movie(1))
+    plan = planner.make_plan(existing=existing)
+    assert len(plan.skipped) == 1
+    assert [m["ids"]["trakt"] for m in plan.requests[0].payload["movies"]] == [2]
+    # the planned play is added to the history
+    assert history(movie(2)) <= existing
+
+    results = list(planner.run(plan))
+    assert [r.skipped for r in results] == [1, 0]
+    assert j.count_pending() == 0
+
+
+def test_whole_season_is_one_object(j, posted):
+    j.append({episode(i): D1 for i in (1, 2, 3)}, show_trakt=SHOW, whole=True)
+    j.append({episode(i, season=2): D1 for i in (4, 5)}, show_trakt=SHOW, whole=True)
+
+    plan = planner.make_plan()
+    assert plan.seasons == 2
+    payload = plan.requests[0].payload
+    assert "episodes" not in payload
+    # the seasons of a show go in one show object
+    assert [s["number"] for s in payload["shows"][0]["seasons"]] == [1, 2]
+    assert len(plan.requests[0].plays) == 5
+
+
+def test_season_known_in_catalog_is_one_object(j, posted, monkeypatch):
+    monkeypatch.setattr(catalog, "_default", StubCatalog({(SHOW, 1): {1, 2, 3}, (SHOW, 2): {4, 5, 6}}))
+    j.append({episode(i): D1 for i in (1, 2, 3)}, show_trakt=SHOW)
+    # not every episode of season 2
+    j.append({episode(i, season=2): D1 for i in (4, 5)}, show_trakt=SHOW)
+
+    payload = planner.make_plan().requests[0].payload
+    assert [s["number"] for s in payload["shows"][0]["seasons"]] == [1]
+    assert [e["ids"]["trakt"] for e in payload["episodes"]] == [4, 5]
+
+
+def test_mixed_dates_are_sent_as_episodes(j, posted):
+    j.append({episode(1): D1, episode(2): D2}, show_trakt=SHOW)
+
+    plan = planner.make_plan()
+    assert plan.seasons == 0
+    assert len(plan.requests[0].payload["episodes"]) == 2
+
+
+def test_partial_season_falls_back_to_episodes(j, posted):
+    j.append({episode(i): D1 for i in (1, 2, 3)}, show_trakt=SHOW, whole=True)
+
+    # sending the season would add episode 1 again
+    plan = planner.make_plan(existing=history(episode(1)))
+    assert plan.seasons == 0
+    assert [e["ids"]["trakt"] for e in plan.requests[0].payload["episodes"]] == [2, 3]
+
+
+def test_replay_after_partial_send(j, posted):
+    j.append({movie(i): D1 for i in (1, 2, 3)})
+
+    plan = planner.make_plan(chunk_size=2)
+    assert len(plan.requests) == 2
+
+    # the first request was confirmed in an earlier run
+    j.mark_sent(plan.requests[0].entries)
+    list(planner.run(plan))
+    assert [[m["ids"]["trakt"] for m in p["movies"]] for p in posted] == [[3]]
+
+    posted.clear()
+    assert list(planner.run(plan)) == []
+    assert posted == []
+
+
+def test_season_loses_a_play_before_replay(j, posted):
+    j.append({episode(i): D1 for i in (1, 2, 3)}, show_trakt=SHOW, whole=True)
+    plan = planner.make_plan()
+
+    first = plan.requests[0].plays[0]
+    j.mark_sent(first)
+    list(planner.run(plan))
+    # the season would add the sent episode again: the rest is sent episode by episode
+    assert [e["ids"]["trakt"] for e in posted[0]["episodes"]] == [2, 3]
+
+
+def test_save_and_load(j, posted, tmp_path):
+    j.append({episode(i): D1 for i in (1, 2)}, show_trakt=SHOW, whole=True)
+    j.append({movie(1): D1})
+    plan = planner.make_plan()
+
+    path = str(tmp_path / "plan.json")
+    planner.save(plan, path)
+    assert planner.load(path) == plan
+
+
+def test_duplicate_seasons_are_kept_without_merge(j, posted, monkeypatch):
+    monkeypatch.setattr(catalog, "_default", StubCatalog({(SHOW, 2): {4, 5}}))
+    for _ in range(2):
+        j.append({episode(i): D1 for i in (1, 2, 3)}, show_trakt=SHOW, whole=True)
+        j.append({episode(i, season=2): D1 for i in (4, 5)}, show_trakt=SHOW)
+
+    plan = planner.make_plan(merge=False)
+    assert plan.seasons == 4
+    assert [s["number"] for s in plan.requests[0].payload["shows"][0]["seasons"]] == [1, 2, 1, 2]
+
+    list(planner.run(plan, existing=set()))
+    assert len(posted[0]["shows"][0]["seasons"]) == 4
+    assert j.count_pending() == 0
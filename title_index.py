@@ -0,0 +1,116 @@
+"""
+Offline fuzzy matching of show titles (e.g. shows selected from the wikipedia dump) to the shows
+already known locally - in the catalog, or in cached search results - so only the titles that are
+left have to be searched on trakt.
+
+Titles are broken into trigrams (3 character substrings of the cache.normalize()d title, padded
+at the start and end) and an inverted index maps each trigram to the shows that contain it. The
+score is the Dice coefficient of the two sets of trigrams, adjusted by the debut year when both
+are known. As in auto_match.py, a match is only accepted when it scores at least THRESHOLD and
+clearly ahead of the runner-up.
+
+Common trigrams ("the", " th") are shared by a large part of all titles, so not every show that
+shares a trigram is scored: a show close enough to matter shares most of a title's trigrams, so
+it has to contain at least one of its rarest ones, and only those are looked up (prefix filtering).
+
+python title_index.py "title" ...   # the best matches for some titles
+"""
+
+import json
+import math
+import sys
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# local
+import cache
+import catalog
+
+
+# minimum score to accept a match
+THRESHOLD = 0.9
+# how far ahead of the second best show the best one has to be
+MARGIN = 0.1
+
+# added to the score of a show that debuted within a year of the expected one, and
+# taken off one that debuted further away
+YEAR_BONUS = 0.2
+
+
+def trigrams(title) -> frozenset:
+    padded = f"  {cache.normalize(title)} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def known_shows() -> List[dict]:
+    """ every show (as in trakt's api) in the catalog or in cached search results """
+    shows = {show["ids"]["slug"]: show for show in catalog.default().shows()}
+    for results in cache.default().values("search:show:"):
+        for r in results:
+            shows.setdefault(r["show"]["ids"]["slug"], r["show"])
+    return list(shows.values())
+
+
+class TitleIndex:
+    def __init__(self, shows: Iterable[dict]):
+        self.shows = list(shows)
+        self.grams = [trigrams(show.get("title") or "") for show in self.shows]
+
+        # trigram -> numbers of the shows with it
+        self.postings: Dict[str, List[int]] = {}
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+
+    def candidates(self, title, year=None, min_score=0.0) -> List[Tuple[float, dict]]:
+        """ (score, show) of the shows scoring at least `min_score` for `title`, best first """
+        grams = trigrams(title)
+
+        # a show with a Dice coefficient of at least `dice` shares at least `needed` trigrams with the title
+        dice = min_score - (YEAR_BONUS if year else 0.0)
+        needed = max(1, math.ceil(dice * len(grams) / (2 - dice) - 1e-9)) if dice > 0 else 1
+        rarest = sorted(grams, key=lambda gram: len(self.postings.get(gram, ())))
+        found = set()
+        for gram in rarest[:len(grams) - needed + 1]:
+            found.update(self.postings.get(gram, ()))
+
+        # and has between needed and len(grams) * (2 - dice) / dice trigrams itself
+        longest = len(grams) * (2 - dice) / dice + 1e-9 if dice > 0 else math.inf
+
+        scored = []
+        for i in found:
+            if not needed <= len(self.grams[i]) <= longest:
+                continue
+            score = 2 * len(grams & self.grams[i]) / (len(grams) + len(self.grams[i]))
+            debut = self.shows[i].get("year")
+            if year and debut:
+                score += YEAR_BONUS if abs(debut - year) <= 1 else -YEAR_BONUS
+            if score >= min_score:
+                scored.append((score, self.shows[i]))
+        scored.sort(key=lambda s: s[0], reverse=True)
+        return scored
+
+    def match(self, title, year=None) -> Optional[Tuple[dict, float]]:
+        """ (show, score) of the show `title` clearly is, or None """
+        # shows further behind can't be the match, nor be too close to it
+        scored = self.candidates(title, year, THRESHOLD - MARGIN)
+        if not scored:
+            return None
+
+        best, show = scored[0]
+        runner_up = scored[1][0] if len(scored) > 1 else 0.0
+        if best >= THRESHOLD and best - runner_up >= MARGIN:
+            return show, best
+        return None
+
+    def match_many(self, titles: Iterable[str], years: Dict[str, int] = None):
+        """ {title: match(title, its year in `years`)} """
+        years = years or {}
+        return {title: self.match(title, years.get(title)) for title in dict.fromkeys(titles)}
+
+
+if __name__ == "__main__":
+    index = TitleIndex(known_shows())
+    for title in sys.argv[1:]:
+        for score, show in index.candidates(title)[:5]:
+            print(f"{score:.2f}  ({show.get('year')}) {show.get('title')}  [{json.dumps(show['ids'])}]")
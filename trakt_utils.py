@@ -28,9 +28,12 @@ config.ini the first time you run it.
 
 import configparser
 import datetime
-import functools
+import itertools
+import json
 import os
 import pickle
+import threading
+import urllib.parse
 
 # watch out for rate limits!
 # https://trakt.docs.apiary.io/#introduction/rate-limiting
@@ -38,19 +41,40 @@ import time
 import sys
 
 from pprint import pprint
-from typing import Optional
+from typing import List, NamedTuple, Optional
 
 # third-party
+import requests
 import trakt
 import trakt.core
+import trakt.errors
 import trakt.movies
+import trakt.sync
 import trakt.tv
+import trakt.utils
 import tqdm
 
+# local
+import cache
+import catalog
+import journal
+import metrics
+import rate_limit
+import title_index
+
 
 # use a manual offset, since trakt module incorrectly uses utc time instead of local time
 OFFSET = time.timezone
 
+# number of movies/episodes sent in each /sync/history request
+HISTORY_CHUNK = 100
+
+# number of plays fetched per request when reading the user's history
+HISTORY_PAGE = 1000
+
+# number of updated shows fetched per request when refreshing the catalog
+UPDATES_PAGE = 100
+
 
 def get_config():
     cfg = configparser.ConfigParser()
@@ -58,6 +82,17 @@ def get_config():
     return cfg
 
 
+_offline = None
+
+
+def offline():
+    """ True if `offline` is set in the [catalog] section of config.ini: nothing is looked up on or sent to trakt """
+    global _offline
+    if _offline is None:
+        _offline = get_config().getboolean("catalog", "offline", fallback=False)
+    return _offline
+
+
 def update_config(cfg, trakt):
     app = {
         "id": trakt.core.CLIENT_ID,
@@ -71,9 +106,41 @@ def update_config(cfg, trakt):
         cfg.write(cfgfile)
 
 
-def auth_trakt(force_update=False):
+def auth_trakt(force_update=False, share=1.0, worker=False):
+    """
+    `share`: the part of trakt's GET limit this process may use, `worker`: this is a worker process
+    (see coordinator.py for both)
+    """
+    # async_trakt uses this module (imported here, so neither imports the other while it is loaded)
+    import async_trakt
+
     cfg = get_config()
 
+    # every trakt request (GET and POST) goes through one shared, rate limited, keep-alive session
+    session = rate_limit.install(
+        trakt.core,
+        path=None if worker else rate_limit.STATE,
+        share=share,
+        # at least one connection per concurrent lookup
+        pool_size=max(cfg.getint("http", "pool_size", fallback=rate_limit.POOL_SIZE), async_trakt.CONCURRENCY),
+        timeout=(
+            cfg.getfloat("http", "connect_timeout", fallback=rate_limit.TIMEOUT[0]),
+            cfg.getfloat("http", "read_timeout", fallback=rate_limit.TIMEOUT[1]),
+        ),
+        compress=cfg.getboolean("http", "compress", fallback=True),
+    )
+
+    # summary of every trakt call, written at exit (worker processes report theirs to the coordinator instead)
+    if session.limiter.path:
+        metrics.install(
+            cfg.get("metrics", "file", fallback=metrics.METRICS),
+            cfg.getboolean("metrics", "print", fallback=False),
+        )
+
+    if offline() and not force_update:
+        # no credentials needed (or asked for) when nothing is sent
+        return
+
     if force_update:
         username = cfg["user"]["username"]
 
@@ -96,13 +163,33 @@ def auth_trakt(force_update=False):
         update_config(cfg, trakt)
 
 
+class AuthOnFirstRequest(requests.Session):
+    """
+    stands in for trakt.core.session until something authenticates: the first request
+    runs auth_trakt() (which installs the real session) and is then sent through that
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        auth_trakt()
+        headers = kwargs.get("headers")
+        if headers is trakt.core.HEADERS:
+            # trakt.core filled these in before the credentials were loaded
+            headers["trakt-api-key"] = trakt.core.CLIENT_ID
+            headers["Authorization"] = f"Bearer {trakt.core.OAUTH_TOKEN}"
+        return trakt.core.session.request(method, url, *args, **kwargs)
+
+
+if not isinstance(trakt.core.session, rate_limit.RateLimitedSession):
+    trakt.core.session = AuthOnFirstRequest()
+
+
 def safe_auth(f):
     def wrapper(*args, **kwargs):
         try:
-            f(*args, **kwargs)
+            return f(*args, **kwargs)
         except trakt.errors.OAuthException:
             auth_trakt(True)
-            f(*args, **kwargs)
+            return f(*args, **kwargs)
     return wrapper
 
 
@@ -110,29 +197,27 @@ def safe_auth(f):
 # helpers for interface.py
 
 
-def bad_serializer(d):
+_journal = None
+
+
+def get_journal():
     """
-    use `pickle` to serialize episodes into a file for later updating trakt all at once
-    this seems like bad style, just be careful with your pickle files!
+    journal of deferred updates (see journal.py).
+    a serialized.pickle left over from older versions is imported into it on first use
     """
-    pf = "serialized.pickle"
-    od = []
-    if os.path.exists(pf):
-        with open(pf, "rb") as f:
-            od = pickle.load(f)
-    od.append(d)
-    with open(pf, "wb") as f:
-        pickle.dump(od, f)
+    global _journal
+    if _journal is None:
+        _journal = journal.Journal()
 
+        pf = "serialized.pickle"
+        if os.path.exists(pf):
+            with open(pf, "rb") as f:
+                for d in pickle.load(f):
+                    if d:
+                        _journal.append(d)
+            os.rename(pf, pf + ".imported")
 
-def read_serialized():
-    pf = "serialized.pickle"
-    if not os.path.exists(pf):
-        raise Exception("Serialized file does not exist yet. Run a deferred update first.")
-
-    with open(pf, "rb") as f:
-        for res in pickle.load(f):
-            yield res
+    return _journal
 
 
 def display_seasons(seasons):
@@ -144,33 +229,373 @@ def display_seasons(seasons):
             yield ""
 
 
-@functools.lru_cache
-def search_tv(query):
+@trakt.core.get
+def _search(query, media_type):
+    data = yield f"search/{media_type}?query={urllib.parse.quote(query)}"
+    yield data
+
+
+@trakt.core.get
+def _seasons(slug):
+    data = yield f"shows/{slug}/seasons?extended=full"
+    yield data
+
+
+@trakt.core.get
+def _season_episodes(slug, number):
+    data = yield f"shows/{slug}/seasons/{number}?extended=full"
+    yield data
+
+
+# cache.normalize()d query -> (show, score) for the show searches that prematch_shows() matched locally
+_prematched = {}
+
+
+def prematch_shows(queries, years=None, index=None):
+    """
+    match show search queries (and their debut years, {query: year}) to the shows that are already
+    known locally (see title_index.py, or a TitleIndex `index` built for them), so they are not
+    searched on trakt in this run.
+    returns the queries that are left to search
+    """
+    queries = list(queries)
+    if index is None:
+        index = title_index.TitleIndex(title_index.known_shows())
+    left = []
+    for query, match in index.match_many(queries, years).items():
+        if match is None:
+            left.append(query)
+        else:
+            _prematched[cache.normalize(query)] = match
+    return left
+
+
+def prematched(query):
+    """ whether a show search for `query` is answered by its local match (see prematch_shows) """
+    return cache.normalize(query) in _prematched
+
+
+def search(query, media_type, local=True):
+    """
+    search trakt for a "movie" or "show" (results are kept in the persistent cache).
+    returns a list of trakt.movies.Movie or trakt.tv.TVShow.
+    with `local`, a show that prematch_shows() matched is the only result (nothing is searched)
+    """
+    if local and media_type == "show" and prematched(query):
+        show, _ = _prematched[cache.normalize(query)]
+        return [trakt.tv.TVShow(**dict(show))]
+
+    key = f"search:{media_type}:{cache.normalize(query)}"
+    results = cache.default().get(key)
+    if results is None and offline():
+        # only shows that are in the catalog can be found
+        results = [{"type": "show", "show": show} for show in catalog.default().search(query)] if media_type == "show" else []
+    elif results is None:
+        results = _search(query, media_type) or []
+        cache.default().set(key, results)
+        if media_type == "show":
+            catalog.default().put_shows(r["show"] for r in results)
+
+    media_cls = trakt.tv.TVShow if media_type == "show" else trakt.movies.Movie
+    return [media_cls(**dict(r[media_type])) for r in results]
+
+
+def show_seasons(show):
+    """ list of trakt.tv.TVSeason for a trakt.tv.TVShow (kept in the catalog) """
+    seasons = catalog.default().seasons(show.slug)
+    if seasons is None and offline():
+        seasons = []
+    elif seasons is None:
+        seasons = _seasons(show.slug) or []
+        catalog.default().set_seasons(dict(title=show.title, year=show.year, **show.ids), seasons)
+
+    return [
+        trakt.tv.TVSeason(show.title, s["number"], slug=show.slug, **trakt.utils.extract_ids(dict(s)))
+        for s in seasons
+    ]
+
+
+def season_episodes(season):
+    """
+    episodes of a trakt.tv.TVSeason, with a single request (kept in the catalog).
+    `season.episodes` requests every episode separately.
+    """
+    if season._episodes is None:
+        episodes = catalog.default().episodes(season.slug, season.season)
+        if episodes is None and offline():
+            episodes = []
+        elif episodes is None:
+            episodes = _season_episodes(season.slug, season.season) or []
+            catalog.default().set_episodes(season.slug, season.season, episodes)
+        season._build(episodes)
+
+    return season.episodes
+
+
+class LazySeasons:
+    """
+    list-like handle to a show's seasons.
+    the seasons are only looked up (once) when they are first used.
+    """
+
+    def __init__(self, show):
+        self.show = show
+        self._seasons = None
+        self._lock = threading.Lock()
+
+    @property
+    def resolved(self):
+        return self._seasons is not None
+
+    def resolve(self):
+        with self._lock:
+            if self._seasons is None:
+                self._seasons = show_seasons(self.show)
+        return self._seasons
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __getitem__(self, idx):
+        return self.resolve()[idx]
+
+
+def search_tv(query, local=True):
     auth_trakt()  # ?
 
     query = query.replace("'", "")
-    results = trakt.movies.search(query, search_type="show")
+    results = search(query, "show", local)
     return [
         dict([
             ("year", r.year),
             ("title", r.title),
-            ("seasons", r.seasons),
+            ("trakt", r.trakt),
+            ("seasons", LazySeasons(r)),
         ])
         for r in results
     ]
 
 
+def lookup_tv(query):
+    """ search_tv, with the seasons of the first (default) result already looked up """
+    results = search_tv(query)
+    if results:
+        results[0]["seasons"].resolve()
+    return results
+
+
 def search_tv_episodes(season):
     pass
 
 
+@trakt.core.get
+def _updated_shows(start, page):
+    data = yield f"shows/updates/{start}?page={page}&limit={UPDATES_PAGE}"
+    yield data
+
+
+def refresh_catalog(force=False):
+    """
+    drop the seasons and episodes of the catalog's shows that changed on trakt since the last refresh,
+    at most once every `refresh_days` (see config.ini) unless `force`. returns the number of shows dropped
+    """
+    if offline():
+        return 0
+
+    c = catalog.default()
+    started = catalog.now()
+    since = datetime.datetime.now(datetime.timezone.utc) - c.refreshed()
+    days = get_config().getfloat("catalog", "refresh_days", fallback=catalog.REFRESH_DAYS)
+    if not force and since < datetime.timedelta(days=days):
+        return 0
+
+    if since > catalog.UPDATES_WINDOW:
+        # trakt doesn't list updates that far back
+        dropped = c.drop_all()
+    else:
+        start = catalog.timestamp(c.refreshed())
+        dropped = 0
+        page = 1
+        while True:
+            data = _updated_shows(start, page) or []
+            dropped += c.updated((item["show"]["ids"]["slug"], item["updated_at"]) for item in data)
+            if len(data) < UPDATES_PAGE:
+                break
+            page += 1
+
+    c.set_refreshed(started)
+    return dropped
+
+
+def fill_catalog(queries):
+    """
+    look up every show in `queries` (its first search result) with all of its seasons and episodes,
+    e.g. before switching to offline. returns (shows, seasons) found
+    """
+    import async_trakt
+
+    queries = list(queries)
+    prematch_shows(queries)
+    lookups = async_trakt.lookup_tv_many(queries)
+    seasons = [season for results in lookups.values() if results for season in results[0]["seasons"]]
+    async_trakt.episodes_many(seasons)
+    return sum(1 for results in lookups.values() if results), len(seasons)
+
+
+def chunks(iterable, n):
+    itr = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(itr, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def history_item(media, watched_at):
+    """ build a single /sync/history entry (same format as trakt.sync.add_to_history) """
+    data = dict(watched_at=trakt.utils.timestamp(watched_at))
+    data.update(media.ids)
+    return media.media_type, data
+
+
+def history_key(media, watched_at):
+    """ identifies a play in the user's history: (media type, trakt id, day it was watched) """
+    return media.media_type, media.ids["ids"]["trakt"], watched_at.strftime("%Y-%m-%d")
+
+
+@trakt.core.get
+def _history(media_type, page, start, end):
+    params = {"page": page, "limit": HISTORY_PAGE}
+    if start is not None:
+        params["start_at"] = start.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    if end is not None:
+        params["end_at"] = end.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    data = yield f"sync/history/{media_type}?{urllib.parse.urlencode(params)}"
+    yield data
+
+
+def history_index(start=None, end=None, media_types=("movies", "episodes")):
+    """
+    fetch the user's history (optionally only plays between the `start` and `end` datetimes)
+    in bulk, as a set of history_key()s
+    """
+    index = set()
+    for media_type in media_types:
+        page = 1
+        while True:
+            data = _history(media_type, page, start, end) or []
+            for item in data:
+                media = item[item["type"]]
+                index.add((media_type, media["ids"]["trakt"], item["watched_at"][:10]))
+
+            if len(data) < HISTORY_PAGE:
+                break
+            page += 1
+
+    return index
+
+
+def existing_history(start=None, end=None, media_types=("movies", "episodes"), force=False):
+    """
+    history_index() for plays around start/end (the whole history, without them), to pass to sync_history.
+    returns None (nothing is skipped) if `dedupe` is turned off in config.ini, unless `force`
+    """
+    if not force and not get_config().getboolean("sync", "dedupe", fallback=True):
+        return None
+
+    # some slack for timezones
+    day = datetime.timedelta(days=1)
+    return history_index(start and start - day, end and end + day, media_types)
+
+
 @safe_auth
-def non_interactive_episode_add(episode, date_obj):
-    assert isinstance(episode, trakt.tv.TVEpisode)
-    trakt.sync.add_to_history(episode, watched_at=date_obj)
+@trakt.core.post
+def post_history(payload):
+    result = yield "sync/history", payload
+    yield result
+
+
+# errors after which an upload can be resumed later
+UPLOAD_ERRORS = (json.decoder.JSONDecodeError, trakt.errors.TraktException, requests.RequestException)
+
 
-    # rate limit: 2 POST calls every 1 sec
-    time.sleep(1)
+class SyncResult(NamedTuple):
+    items: List  # every (media, watched_at) pair handled in this chunk
+    added: int
+    not_found: int
+    skipped: int  # pairs that were already in the user's history
+
+
+def sync_history(items, chunk_size=HISTORY_CHUNK, existing=None):
+    """
+    add (media, watched_at) pairs (movies and/or episodes) to the user's history,
+    sending `chunk_size` of them per request.
+    `media` only needs `media_type` and `ids` (e.g. trakt objects or journal.Entry).
+
+    if `existing` (a set from history_index) is given, pairs already in it are not sent again.
+    yields a SyncResult for each chunk
+    """
+    def send(handled, to_send, skipped):
+        payload = {}
+        for media, watched_at in to_send:
+            media_type, data = history_item(media, watched_at)
+            payload.setdefault(media_type, []).append(data)
+
+        result = (post_history(payload) if payload else None) or {}
+        added = sum(result.get("added", {}).values())
+        not_found = sum(len(v) for v in result.get("not_found", {}).values())
+        return SyncResult(handled, added, not_found, skipped)
+
+    handled, to_send, skipped = [], [], 0
+    for media, watched_at in items:
+        handled.append((media, watched_at))
+
+        if existing is not None:
+            key = history_key(media, watched_at)
+            if key in existing:
+                skipped += 1
+                continue
+            # also drops duplicates within `items`
+            existing.add(key)
+
+        to_send.append((media, watched_at))
+        if len(to_send) >= chunk_size:
+            yield send(handled, to_send, skipped)
+            handled, to_send, skipped = [], [], 0
+
+    if handled:
+        yield send(handled, to_send, skipped)
+
+
+def upload_journal(batches=None, existing=None):
+    """
+    send the unsent entries of the journal (optionally only from `batches`) to trakt as planned by
+    planner.make_plan (duplicates merged, whole seasons as one object), marking them as sent as
+    each request is confirmed. yields a SyncResult per request.
+
+    `existing` is a history_index() that the caller keeps across several uploads (what is sent is
+    added to it), instead of fetching the history again for every upload
+    """
+    j = get_journal()
+
+    # if an earlier upload of these was interrupted, trakt may have gotten the last chunk
+    # without us marking it as sent: always check the history then, so nothing is sent twice
+    interrupted = set(j.interrupted())
+    resuming = bool(interrupted if batches is None else interrupted.intersection(batches))
+    j.start_upload(batches)
+
+    dates = j.date_range(batches)
+    if existing is None and dates:
+        existing = existing_history(*dates, j.media_types(batches), force=resuming)
+
+    # planner uses this module (imported here, so neither imports the other while it is loaded)
+    import planner
+
+    # plays that are already on trakt are planned as skipped, and count as sent too
+    yield from planner.run(planner.make_plan(batches, existing, merge=existing is not None))
 
 # ----
 
@@ -219,22 +644,29 @@ def date_chooser(media, media_type) -> Optional[datetime.datetime]:
     return date_obj
 
 
-def add_media_interactive(title: str, media_type: str):
-    """
-    1) Search trakt.tv for a movie/tv with title.
-    2) interactively ask user for selection
-    3) update user's history with selection
-    """
+def clean_query(title: str, media_type: str) -> Optional[str]:
+    """ search query for a line of {media_type}.txt (None if the line should be skipped) """
     if media_type == "show":
         # expects format 'S01 - tv show title'
         cleaned = " - ".join(title.split(" - ")[1:]).strip()
     else:
         cleaned = title
-    # remove quotes from search query
     if cleaned.startswith("?"):
+        return None
+    # remove quotes from search query
+    return cleaned.replace("'", "")
+
+
+def add_media_interactive(title: str, media_type: str):
+    """
+    1) Search trakt.tv for a movie/tv with title.
+    2) interactively ask user for selection
+    3) update user's history with selection
+    """
+    cleaned = clean_query(title, media_type)
+    if cleaned is None:
         return
-    cleaned = cleaned.replace("'", "")
-    results = trakt.movies.search(cleaned, search_type=media_type)
+    results = search(cleaned, media_type)
 
     print(f"Choose the matching result for '{title}' (or -1 to skip):")
     for idx, media in enumerate(results):
@@ -251,7 +683,7 @@ def add_media_interactive(title: str, media_type: str):
         if media_type == "show":
             print("Assuming manual input, searching...")
             cleaned = _choice.strip()
-            results = trakt.movies.search(cleaned, search_type=media_type)
+            results = search(cleaned, media_type)
             print(f"Choose the matching result for '{title}':")
             for idx, media in enumerate(results):
                 print(f"{idx}: ({media.year})\t{media.title}")
@@ -267,7 +699,8 @@ def add_media_interactive(title: str, media_type: str):
 
     if media_type == "show":
         print("Choose the appropriate season:")
-        for idx, season in enumerate(results[choice].seasons):
+        seasons = show_seasons(results[choice])
+        for idx, season in enumerate(seasons):
             print(f"{idx}: ({season.first_aired})\t{season.title}")
 
         try:
@@ -276,7 +709,7 @@ def add_media_interactive(title: str, media_type: str):
             print("Skipping this media (input must be integer)")
             return
 
-        media = results[choice].seasons[season_choice].episodes
+        media = season_episodes(seasons[season_choice])
     else:
         media = results[choice]
 
@@ -285,26 +718,32 @@ def add_media_interactive(title: str, media_type: str):
         return
 
     if media_type == "show" and isinstance(media, list):
-        for episode in tqdm.tqdm(media):
-            assert isinstance(episode, trakt.tv.TVEpisode)
-            trakt.sync.add_to_history(episode, watched_at=date_obj)
-
-            # rate limit: 2 POST calls every 1 sec
-            time.sleep(1)
+        with tqdm.tqdm(total=len(media)) as bar:
+            for res in sync_history((episode, date_obj) for episode in media):
+                bar.update(len(res.items))
 
     elif isinstance(media, trakt.movies.Movie):
         trakt.sync.add_to_history(media, watched_at=date_obj)
 
 
-def add_media_to_history(media_type):
-    """ Add all media from {media_type}.txt to user's trakt.tv account """
-    with open(f"{media_type}.txt") as f:
+def add_media_to_history(media_type, fname=None):
+    """ Add all media from {media_type}.txt (or fname) to user's trakt.tv account """
+    import async_trakt
+
+    with open(fname or f"{media_type}.txt") as f:
         medias = f.readlines()
 
-    for media in medias:
-        if media.strip().endswith(":"):
-            continue
-        add_media_interactive(media.strip(), media_type)
+    titles = [media.strip() for media in medias if not media.strip().endswith(":")]
+
+    # search for every title concurrently up front, the interactive loop then reads from the cache.
+    # shows that are already known locally don't need to be searched at all
+    queries = filter(None, (clean_query(title, media_type) for title in titles))
+    if media_type == "show":
+        queries = prematch_shows(queries)
+    async_trakt.search_many(queries, media_type)
+
+    for title in titles:
+        add_media_interactive(title, media_type)
 
 
 def main(media_type):
@@ -35,6 +35,9 @@ January
 2. return list of watched tv shows
 requires:
 SELECTED = "shows.txt"
+the cleaned show names are also kept in SELECTED_INDEX (sqlite), so new selections can be
+checked against and added to SELECTED without re-reading and rewriting all of it.
+the index is rebuilt whenever SELECTED is edited by hand.
 
 3. run through a structured (name / season number / date finished) list of tv shows
 This is meant for those who may have kept track of the date they finished tv shows before using trakt.
@@ -43,43 +46,142 @@ show ::: season-number ::: YYYY/MM/DD
 """
 
 import datetime as dt
+import heapq
+import mmap
 import re
 import os
+import sqlite3
 
-from typing import Set
+from typing import Dict, Iterable, Iterator, List
 
 
 FNAME = "wikipedia-tv-shows.txt"
 SELECTED = "shows.txt"
+SELECTED_INDEX = "shows.sqlite"
 STRUCTURED = "shows-structured.txt"
 
+# lines of FNAME
+YEAR_RE = re.compile(r"[0-9]*$")
+MONTH_RE = re.compile(r"[A-Za-z]*$")
+
 
 def clean_paste(s):
     # only save ascii characters from our tv show names
-    if chr(8211) in s:
-        _, s = s.split(chr(8211))
+    # everything after the first en dash (the title itself may have more of them)
+    _, dash, rest = s.partition(chr(8211))
+    if dash:
+        s = rest
     s = s.encode("ascii", "ignore").decode()
     return s.strip()
 
 
-def serialize(updated: Set[bytes]):
-    old = set()
-    if os.path.exists(SELECTED):
-        with open(SELECTED) as f:
-            old = set(map(clean_paste, f.readlines()))
+def _stamp():
+    """ identifies the current version of SELECTED, to notice when it was edited by hand """
+    if not os.path.exists(SELECTED):
+        return ""
+    st = os.stat(SELECTED)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def _index(normalize=False) -> sqlite3.Connection:
+    """
+    SELECTED_INDEX, rebuilt first if SELECTED changed since the index was written.
+    with `normalize`, a SELECTED that was edited by hand is also rewritten as sorted plain show
+    names (as serialize always did), so new shows can be merged into it
+    """
+    db = sqlite3.connect(SELECTED_INDEX)
+    db.execute("CREATE TABLE IF NOT EXISTS shows (title TEXT PRIMARY KEY)")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
 
-    current = set(map(clean_paste, updated))
-    current.update(old)
+    # the stamp of a SELECTED that was indexed but not rewritten is prefixed with "raw:"
+    stamp = _stamp()
+    row = db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+    if row is None or row[0] not in ([stamp] if normalize else [stamp, f"raw:{stamp}"]):
+        _rebuild_index(db, normalize)
+    return db
 
-    with open(SELECTED, "w") as f:
-        for show in sorted(current):
+
+def _rebuild_index(db, normalize):
+    """ index SELECTED, cleaning it up first (as older versions of serialize did) with `normalize` """
+    shows = set()
+    if os.path.exists(SELECTED):
+        with open(SELECTED) as f:
+            shows = set(map(clean_paste, f))
+        shows.discard("")
+
+        if normalize:
+            with open(SELECTED, "w") as f:
+                for show in sorted(shows):
+                    f.write(show)
+                    f.write("\n")
+
+    with db:
+        db.execute("DELETE FROM shows")
+        db.executemany("INSERT INTO shows VALUES (?)", ((show,) for show in shows))
+        db.execute("REPLACE INTO meta VALUES ('stamp', ?)", (_stamp() if normalize else f"raw:{_stamp()}",))
+
+
+def _line_at(f, pos):
+    """ (offset, line) of the first line starting at or after pos """
+    f.seek(max(pos - 1, 0))
+    if pos > 0:
+        f.readline()
+    return f.tell(), f.readline()
+
+
+def _insertion_point(f, show: bytes) -> int:
+    """ offset of the first line of the sorted file f that sorts after show (binary search) """
+    lo, hi = 0, os.fstat(f.fileno()).st_size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        _, line = _line_at(f, mid)
+        if not line or line.rstrip(b"\n") > show:
+            hi = mid
+        else:
+            lo = mid + 1
+    return _line_at(f, lo)[0]
+
+
+def _insert_sorted(new: List[str]):
+    """ merge the sorted shows in `new` into SELECTED, rewriting only the part after the first one """
+    if not os.path.exists(SELECTED):
+        open(SELECTED, "w").close()
+
+    with open(SELECTED, "rb+") as f:
+        pos = _insertion_point(f, new[0].encode())
+        f.seek(pos)
+        tail = [line.rstrip(b"\n") for line in f]
+        f.seek(pos)
+        f.truncate()
+        for show in heapq.merge(tail, (show.encode() for show in new)):
             f.write(show)
-            f.write("\n")
+            f.write(b"\n")
+
+
+def serialize(updated: Iterable[str]):
+    """ add the shows in `updated` that are not in SELECTED yet """
+    db = _index(normalize=True)
+    try:
+        current = set(map(clean_paste, updated))
+        current.discard("")
+        new = sorted(
+            show for show in current
+            if db.execute("SELECT 1 FROM shows WHERE title = ?", (show,)).fetchone() is None
+        )
+        if not new:
+            return
+
+        _insert_sorted(new)
+        with db:
+            db.executemany("INSERT INTO shows VALUES (?)", ((show,) for show in new))
+            db.execute("REPLACE INTO meta VALUES ('stamp', ?)", (_stamp(),))
+    finally:
+        db.close()
 
 
 def get_structured():
     with open(STRUCTURED) as f:
-        for line in f.readlines():
+        for line in f:
             if line.strip():
                 try:
                     show, season_s, date_s = line.strip().split(" ::: ")
@@ -93,37 +195,73 @@ def get_structured():
 
 
 def get_selected():
+    if not os.path.exists(SELECTED):
+        raise FileNotFoundError(SELECTED)
+    # SELECTED is only read: if it was edited by hand, it is cleaned up the next time shows are added
     with open(SELECTED) as f:
-        for line in f.readlines():
-            if line.strip():
-                if chr(8211) in line:
-                    # wikipedia has unicode characters similar to hyphens: '–'
-                    show = line.strip().split(chr(8211))[1].strip()
-                    yield show
-                else:
-                    yield line.strip()
+        for line in f:
+            line = line.strip()
+            if line:
+                # wikipedia has unicode characters similar to hyphens: '–'
+                _, dash, show = line.partition(chr(8211))
+                yield show.strip() if dash else line
 
 
-def find_movies(limit=0):
+def read_lines(fname, use_mmap=False) -> Iterator[str]:
+    """ lazily yield the lines of fname, optionally through a memory map (for very large files) """
+    if not use_mmap:
+        with open(fname) as f:
+            yield from f
+        return
+
+    if os.path.getsize(fname) == 0:
+        return
+    with open(fname, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b""):
+            yield line.decode()
+
+
+def parse_lines(lines, limit=0) -> Iterator[str]:
     year = 0
+    counter = 0
 
+    for line in lines:
+        line = line.strip()
+        if not line:
+            pass
+        elif YEAR_RE.match(line):
+            year = int(line)
+        elif MONTH_RE.match(line):
+            pass
+        else:
+            counter += 1
+            yield f"{year} - {line}"
+            if limit > 0 and counter >= limit:
+                return
+
+
+def find_movies(limit=0, use_mmap=False):
+    """
+    yields the shows in FNAME as they are read, so callers can start
+    using the first ones before the whole file has been parsed
+    """
     if not os.path.exists(FNAME):
         raise Exception("Read docstring for txt_tv_parser.py")
 
-    counter = 0
-    with open(FNAME) as f:
-        for line in f.readlines():
-            if not line.strip():
-                pass
-            elif re.match(r"[0-9]*$", line.strip()):
-                year = int(line.strip())
-            elif re.match(r"[A-Za-z]*$", line.strip()):
-                pass
-            else:
-                counter += 1
-                yield f"{year} - {line.strip()}"
-                if limit > 0 and counter >= limit:
-                    return
+    yield from parse_lines(read_lines(FNAME, use_mmap), limit)
+
+
+def debut_years() -> Dict[str, int]:
+    """ {show name (as in SELECTED): year it debuted} for the shows in FNAME (empty if there is no FNAME) """
+    if not os.path.exists(FNAME):
+        return {}
+
+    years = {}
+    for record in find_movies():
+        year, _, line = record.partition(" - ")
+        if int(year):
+            years.setdefault(clean_paste(line), int(year))
+    return years
 
 
 if __name__ == "__main__":